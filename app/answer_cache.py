@@ -0,0 +1,314 @@
+# answer_cache.py - 回答快取（stale-while-revalidate 與離線備援）
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+try:
+    from . import memory_budget, rate_limit, similarity
+except ImportError:
+    import memory_budget
+    import rate_limit
+    import similarity
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'bot_data.db'
+
+# 各意圖的新鮮期（秒），超過後仍保留舊回答作為備援
+FRESH_TTL = {
+    'price': 6 * 3600,
+    'spec': 7 * 24 * 3600,
+    'compare': 3 * 24 * 3600,
+    'recommend': 24 * 3600,
+    'ranking': 24 * 3600,
+    'review': 3 * 24 * 3600,
+}
+DEFAULT_FRESH_TTL = 24 * 3600
+
+# 上游（OpenAI）連續失敗達門檻後，在冷卻時間內只提供舊回答
+FAILURE_THRESHOLD = 3
+FAILURE_COOLDOWN = 60
+
+# 舊回答附上的資料時間以台灣時間顯示（與伺服器時區無關）
+DISPLAY_TIMEZONE = timezone(timedelta(hours=8))
+
+_state_lock = threading.Lock()
+_consecutive_failures = 0
+_circuit_opened_at = 0.0
+_refreshing = set()
+
+# 近似查詢索引（首次查詢時從資料庫載入最近的查詢）
+similar_queries = similarity.SimilarQueryIndex()
+_similar_queries_loaded = False
+memory_budget.register_store(
+    'similar_queries', lambda: similar_queries, similar_queries.evict, 32,
+    measure=similar_queries.approximate_bytes
+)
+
+# 命中統計
+_counters = {'fresh': 0, 'stale': 0, 'similar': 0, 'miss': 0}
+
+# 上游產生回答的輸出長度與延遲，依種類（例如 text:price、structured:price）累計
+_generation_stats: Dict[str, Dict[str, float]] = {}
+
+
+class UpstreamUnavailable(Exception):
+    """上游服務目前被判定為故障，且沒有可用的舊回答"""
+
+
+def normalize_query(text: str) -> str:
+    """正規化查詢字串（全半形、大小寫、空白與標點）
+
+    型號中的 + 有意義（Galaxy S24+ 與 Galaxy S24 是不同產品），先轉成 plus 再移除標點
+    """
+    text = unicodedata.normalize('NFKC', text or '').casefold().replace('+', 'plus')
+    return re.sub(r'[\s\W_]+', '', text)
+
+
+def get_entry(intent: str, query: str, language: str = 'zh-tw') -> Optional[Tuple[str, float]]:
+    """取得快取的回答與更新時間"""
+    return _get_entry_by_key(intent, normalize_query(query), language)
+
+
+def _get_entry_by_key(intent: str, query_key: str, language: str) -> Optional[Tuple[str, float]]:
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT answer, updated_at FROM answer_cache WHERE intent = ? AND query_key = ? AND language = ?',
+            (intent, query_key, language)
+        )
+        row = cursor.fetchone()
+        conn.close()
+        return (row[0], row[1]) if row else None
+    except Exception as e:
+        logger.error(f"讀取回答快取失敗: {e}")
+        return None
+
+
+_STORE_SQL = '''
+    INSERT INTO answer_cache (intent, query_key, language, query, answer, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(intent, query_key, language) DO UPDATE SET
+        query = excluded.query,
+        answer = excluded.answer,
+        updated_at = excluded.updated_at
+'''
+
+
+def store_answer(intent: str, query: str, answer: str, language: str = 'zh-tw') -> bool:
+    """儲存最新一次成功的回答"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute(_STORE_SQL, (intent, normalize_query(query), language, query, answer, time.time()))
+        conn.commit()
+        conn.close()
+        similar_queries.add(intent, language, normalize_query(query))
+        return True
+    except Exception as e:
+        logger.error(f"寫入回答快取失敗: {e}")
+        return False
+
+
+def check_schema() -> Optional[str]:
+    """確認資料庫已存在且回答快取可寫入（只編譯寫入語句，不寫入也不建立檔案），回傳錯誤訊息"""
+    try:
+        conn = sqlite3.connect(f'file:{DB_PATH}?mode=rw', uri=True)
+        try:
+            conn.execute('EXPLAIN ' + _STORE_SQL, ('', '', '', '', '', 0.0))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return str(e)
+    return None
+
+
+def _load_similar_queries():
+    """從資料庫載入最近的查詢建立近似索引（每個行程一次）"""
+    global _similar_queries_loaded
+    with _state_lock:
+        if _similar_queries_loaded:
+            return
+        _similar_queries_loaded = True
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT intent, language, query_key FROM answer_cache ORDER BY updated_at DESC LIMIT ?',
+            (similar_queries.max_entries,)
+        )
+        rows = cursor.fetchall()
+        conn.close()
+    except Exception as e:
+        logger.error(f"載入近似查詢索引失敗: {e}")
+        return
+    for intent, language, query_key in reversed(rows):
+        similar_queries.add(intent, language, query_key)
+
+
+def find_entry(intent: str, query: str, language: str = 'zh-tw') -> Optional[Tuple[str, float]]:
+    """先找完全相同的查詢，找不到時改用近似查詢"""
+    query_key = normalize_query(query)
+    entry = _get_entry_by_key(intent, query_key, language)
+    if entry:
+        return entry
+
+    _load_similar_queries()
+    similar_key = similar_queries.find(intent, language, query_key)
+    if similar_key and similar_key != query_key:
+        entry = _get_entry_by_key(intent, similar_key, language)
+        if entry:
+            _count('similar')
+        return entry
+    return None
+
+
+def _count(name: str):
+    with _state_lock:
+        _counters[name] += 1
+
+
+def record_generation(kind: str, completion_tokens: Optional[int], seconds: float):
+    """記錄一次上游產生回答的輸出 tokens 與耗時"""
+    with _state_lock:
+        entry = _generation_stats.setdefault(kind, {'calls': 0, 'completion_tokens': 0, 'seconds': 0.0})
+        entry['calls'] += 1
+        entry['completion_tokens'] += completion_tokens or 0
+        entry['seconds'] += seconds
+
+
+def stats() -> Dict:
+    """回答快取的命中統計與各種回答的平均輸出長度、延遲"""
+    with _state_lock:
+        counters = dict(_counters)
+        generation = {kind: dict(entry) for kind, entry in _generation_stats.items()}
+    total = sum(counters[name] for name in ('fresh', 'stale', 'miss'))
+    counters['hit_rate'] = round((counters['fresh'] + counters['stale']) / total, 4) if total else 0.0
+    counters['similar_index'] = similar_queries.stats()
+    counters['generation'] = {
+        kind: {
+            'calls': entry['calls'],
+            'avg_completion_tokens': round(entry['completion_tokens'] / entry['calls'], 1),
+            'avg_seconds': round(entry['seconds'] / entry['calls'], 3),
+        } for kind, entry in generation.items()
+    }
+    return counters
+
+
+def upstream_available() -> bool:
+    """判斷是否應呼叫上游；冷卻時間過後只放行一次試探，其餘呼叫者等試探結果"""
+    global _circuit_opened_at
+    with _state_lock:
+        if _consecutive_failures < FAILURE_THRESHOLD:
+            return True
+        now = time.time()
+        if now - _circuit_opened_at < FAILURE_COOLDOWN:
+            return False
+        # 重新起算冷卻時間：試探成功會關閉斷路器，失敗或沒有回報時下一個冷卻後再試探一次
+        _circuit_opened_at = now
+        return True
+
+
+def record_success():
+    """記錄上游呼叫成功"""
+    global _consecutive_failures
+    with _state_lock:
+        _consecutive_failures = 0
+
+
+def record_failure():
+    """記錄上游呼叫失敗"""
+    global _consecutive_failures, _circuit_opened_at
+    with _state_lock:
+        _consecutive_failures += 1
+        if _consecutive_failures >= FAILURE_THRESHOLD:
+            _circuit_opened_at = time.time()
+
+
+def _call_upstream(generate: Callable[[], str]) -> str:
+    """呼叫上游並更新健康狀態（依目前用戶扣除額度並排隊，被流量控制拒絕不算上游失敗）"""
+    def attempt() -> str:
+        try:
+            answer = generate()
+        except Exception:
+            record_failure()
+            raise
+        if not answer:
+            record_failure()
+            raise ValueError('上游回傳空白回答')
+        record_success()
+        return answer
+
+    return rate_limit.call_upstream(attempt)
+
+
+def regenerate(intent: str, query: str, generate: Callable[[], str], language: str = 'zh-tw') -> str:
+    """立即重新產生並儲存回答（供預熱與批次作業使用）"""
+    answer = _call_upstream(generate)
+    store_answer(intent, query, answer, language)
+    return answer
+
+
+def _refresh_in_background(intent: str, query: str, language: str, generate: Callable[[], str]):
+    """在背景重新產生回答，同一查詢同時只會有一個更新"""
+    refresh_key = (intent, normalize_query(query), language)
+    with _state_lock:
+        if refresh_key in _refreshing:
+            return
+        _refreshing.add(refresh_key)
+    if not upstream_available():
+        with _state_lock:
+            _refreshing.discard(refresh_key)
+        return
+
+    def worker():
+        try:
+            store_answer(intent, query, _call_upstream(generate), language)
+        except Exception as e:
+            logger.warning(f"背景更新回答失敗 ({intent}: {query}): {e}")
+        finally:
+            with _state_lock:
+                _refreshing.discard(refresh_key)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def _with_data_time(answer: str, updated_at: float) -> str:
+    """在舊回答後附上資料時間"""
+    data_time = datetime.fromtimestamp(updated_at, DISPLAY_TIMEZONE).strftime('%Y-%m-%d %H:%M')
+    return f"{answer}\n\n（資料時間：{data_time} 台灣時間）"
+
+
+def serve(intent: str, query: str, generate: Callable[[], str], language: str = 'zh-tw',
+          render: Optional[Callable[[str], str]] = None) -> str:
+    """
+    依 stale-while-revalidate 策略取得回答：
+    新鮮的快取直接回傳；過期的快取立即回傳並在背景更新；
+    上游故障時只提供舊回答，沒有舊回答則拋出 UpstreamUnavailable。
+    快取內容為結構化紀錄時，以 render 轉成回覆文字
+    回答會由所有用戶共用，generate 不可帶入個別用戶的對話歷史
+    """
+    render = render or (lambda answer: answer)
+    entry = find_entry(intent, query, language)
+    if entry:
+        answer, updated_at = entry
+        if time.time() - updated_at < FRESH_TTL.get(intent, DEFAULT_FRESH_TTL):
+            _count('fresh')
+            return render(answer)
+        _count('stale')
+        _refresh_in_background(intent, query, language, generate)
+        return _with_data_time(render(answer), updated_at)
+
+    _count('miss')
+    if not upstream_available():
+        raise UpstreamUnavailable(f"上游服務暫停中，且無 {intent} 快取: {query}")
+
+    answer = _call_upstream(generate)
+    store_answer(intent, query, answer, language)
+    return render(answer)
@@ -19,6 +19,9 @@ import os
 import sqlite3
 import json
 import re
+import difflib
+import threading
+import time
 from datetime import datetime, timedelta
 from langdetect import detect, DetectorFactory
 import logging
@@ -27,6 +30,22 @@ from typing import Dict, List, Optional, Tuple
 from bs4 import BeautifulSoup
 import urllib.parse
 
+try:
+    from . import (
+        answer_cache, hot_queries, maintenance, memory_budget, preferences, profiling, rate_limit, render,
+        similarity
+    )
+except ImportError:
+    import answer_cache
+    import hot_queries
+    import maintenance
+    import memory_budget
+    import preferences
+    import profiling
+    import rate_limit
+    import render
+    import similarity
+
 # 設定語言偵測的隨機種子，確保結果一致性
 DetectorFactory.seed = 0
 
@@ -40,22 +59,46 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
 # LINE Bot 設定
-line_bot_api = MessagingApi(
-    ApiClient(
-        Configuration(
-            access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
-        )
-    )
-)
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
 
 # OpenAI 設定
 from openai import OpenAI
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+def init_clients():
+    """
+    建立 LINE 與 OpenAI 的 HTTP 客戶端
+    預先載入（preload）後 fork 出的 worker 需重新呼叫，避免共用 master 的連線池
+    """
+    global line_bot_api, client
+    line_bot_api = MessagingApi(
+        ApiClient(
+            Configuration(
+                access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+            )
+        )
+    )
+    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+init_clients()
 
 # 全域變數
 user_conversations = {}
+# gthread worker 中多個請求執行緒與記憶體檢查執行緒會同時讀寫對話記錄
+conversations_lock = threading.Lock()
 product_database = {}
+cart_version_cache = {}
+cart_summary_cache = {}
+cart_match_cache = {}
+
+# 購物車版本快取秒數（多個 worker 時，其他 worker 的異動最多延遲這麼久才反映）
+CART_VERSION_TTL = float(os.getenv('CART_VERSION_TTL', '5'))
+
+# 移除商品時名稱不完全相同，相似度需達此門檻，且明顯高於第二接近的商品
+CART_MATCH_THRESHOLD = 0.6
+CART_MATCH_MARGIN = 0.1
+
+# 回答模式：text 為條列文字；structured 時規格、價格與排行榜改用精簡 JSON 並在本地套用範本
+ANSWER_MODE = os.getenv('ANSWER_MODE', 'text')
 
 
 
@@ -66,6 +109,10 @@ def init_database():
         conn = sqlite3.connect('bot_data.db')
         cursor = conn.cursor()
         
+        # 新資料庫啟用 incremental auto_vacuum（須在建表前設定）；WAL 讓讀取不阻擋寫入
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode = WAL')
+        
         # 創建購物車表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS cart (
@@ -74,7 +121,8 @@ def init_database():
                 product TEXT NOT NULL,
                 quantity INTEGER DEFAULT 1,
                 price REAL,
-                added_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                added_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         
@@ -102,6 +150,73 @@ def init_database():
             )
         ''')
         
+        # 創建回答快取表（保留最後一次成功的回答作為備援）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                intent TEXT NOT NULL,
+                query_key TEXT NOT NULL,
+                language TEXT NOT NULL DEFAULT 'zh-tw',
+                query TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (intent, query_key, language)
+            )
+        ''')
+        
+        # 創建熱門查詢紀錄表（每個時間窗保存前幾名）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hot_query_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                window_start REAL NOT NULL,
+                intent TEXT NOT NULL,
+                query TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                error INTEGER NOT NULL DEFAULT 0,
+                saved_at REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_hot_query_window ON hot_query_snapshots (window_start)')
+        
+        # 創建購物車版本表（每次異動遞增，供 ETag 使用）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cart_versions (
+                user_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # 購物車依用戶查詢與分頁
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cart_user_id ON cart (user_id, id)')
+        
+        # 購物車連結產品資料表，加入時記錄價格快照
+        cursor.execute('PRAGMA table_info(cart)')
+        cart_columns = [column[1] for column in cursor.fetchall()]
+        if 'product_id' not in cart_columns:
+            cursor.execute('ALTER TABLE cart ADD COLUMN product_id INTEGER REFERENCES products (id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_name ON products (name COLLATE NOCASE)')
+        
+        # 最後異動時間（加入或數量變更），供保存期限與增量匯出使用
+        if 'updated_at' not in cart_columns:
+            cursor.execute('ALTER TABLE cart ADD COLUMN updated_at TIMESTAMP')
+            cursor.execute('UPDATE cart SET updated_at = added_time')
+        
+        # 購物車以正規化名稱（全半形、大小寫、空白與標點）比對商品，同一用戶同一商品只保留一筆；
+        # 正規化規則改變時重新計算並合併重複商品
+        if 'product_key' not in cart_columns:
+            cursor.execute('ALTER TABLE cart ADD COLUMN product_key TEXT')
+        maintenance.migrate_cart_product_keys(conn)
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_user_product_key ON cart (user_id, product_key)')
+        
+        # 增量匯出依寫入時間讀取新資料
+        cursor.execute('PRAGMA table_info(hot_query_snapshots)')
+        if 'saved_at' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE hot_query_snapshots ADD COLUMN saved_at REAL')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cart_added_time ON cart (added_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cart_updated_at ON cart (updated_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_last_updated ON products (last_updated)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_answer_cache_updated_at ON answer_cache (updated_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_hot_query_saved_at ON hot_query_snapshots (saved_at)')
+        
         conn.commit()
         conn.close()
         logger.info("資料庫初始化完成")
@@ -111,41 +226,132 @@ def init_database():
 # 對話記憶功能
 def get_conversation_history(user_id: str, max_messages: int = 6) -> List[Dict]:
     """獲取用戶對話歷史，限制最大訊息數量避免token超限"""
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    return user_conversations[user_id][-max_messages:]
+    with conversations_lock:
+        return user_conversations.get(user_id, [])[-max_messages:]
 
 def add_to_conversation(user_id: str, role: str, content: str):
     """新增對話到歷史記錄"""
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    
-    user_conversations[user_id].append({
-        'role': role,
-        'content': content,
-        'timestamp': datetime.now().isoformat()
-    })
-    
-    # 限制對話歷史長度
-    if len(user_conversations[user_id]) > 20:
-        user_conversations[user_id] = user_conversations[user_id][-20:]
+    with conversations_lock:
+        history = user_conversations.setdefault(user_id, [])
+        history.append({
+            'role': role,
+            'content': content,
+            'timestamp': datetime.now().isoformat()
+        })
+        
+        # 限制對話歷史長度
+        if len(history) > 20:
+            user_conversations[user_id] = history[-20:]
 
 def clear_old_conversations():
     """清理舊對話記錄"""
     cutoff_time = datetime.now() - timedelta(hours=24)
     
-    for user_id in list(user_conversations.keys()):
-        user_conversations[user_id] = [
-            msg for msg in user_conversations[user_id]
-            if datetime.fromisoformat(msg.get('timestamp', '1970-01-01')) > cutoff_time
-        ]
-        
-        if not user_conversations[user_id]:
+    with conversations_lock:
+        for user_id, history in list(user_conversations.items()):
+            recent = [
+                msg for msg in history
+                if datetime.fromisoformat(msg.get('timestamp', '1970-01-01')) > cutoff_time
+            ]
+            if recent:
+                user_conversations[user_id] = recent
+            else:
+                del user_conversations[user_id]
+
+def evict_conversations(fraction: float) -> int:
+    """記憶體超過預算時，移除最久沒有互動的用戶對話"""
+    with conversations_lock:
+        by_last_message = sorted(
+            user_conversations.items(),
+            key=lambda item: item[1][-1]['timestamp'] if item[1] else ''
+        )
+        evicted = by_last_message[:int(len(by_last_message) * fraction) + 1]
+        for user_id, _ in evicted:
             del user_conversations[user_id]
+    return len(evicted)
+
+# 登記行程內資料的記憶體預算（MB）
+memory_budget.register_store('conversations', lambda: user_conversations, evict_conversations, 64)
+memory_budget.register_store(
+    'cart_versions', lambda: cart_version_cache,
+    lambda fraction: memory_budget.evict_oldest(cart_version_cache, fraction), 4
+)
+memory_budget.register_store(
+    'cart_summaries', lambda: cart_summary_cache,
+    lambda fraction: memory_budget.evict_oldest(cart_summary_cache, fraction), 16
+)
+memory_budget.register_store(
+    'cart_matchers', lambda: cart_match_cache,
+    lambda fraction: memory_budget.evict_oldest(cart_match_cache, fraction), 8
+)
+
+def _create_completion(kind: str, **kwargs):
+    """呼叫 OpenAI 並記錄輸出 tokens 與耗時（可在 /admin/answer-cache 比較文字與結構化模式）"""
+    started = time.monotonic()
+    response = client.chat.completions.create(**kwargs)
+    usage = getattr(response, 'usage', None)
+    answer_cache.record_generation(
+        kind, getattr(usage, 'completion_tokens', None), time.monotonic() - started
+    )
+    return response
+
+def structured_answer_enabled(intent: str) -> bool:
+    """判斷此意圖是否使用結構化回答"""
+    return ANSWER_MODE == 'structured' and intent in render.STRUCTURED_INTENTS
+
+def _request_structured_answer(intent: str, query: str, language: str = 'zh-tw') -> str:
+    """向 OpenAI 取得精簡 JSON 紀錄（不帶對話歷史，同一範本語言的用戶共用同一份）"""
+    user_content = {
+        'spec': f"{query} 的規格",
+        'price': f"{query} 在台灣的新品與二手價格（新品列出最便宜的前三個通路）",
+        'ranking': f"{query} 的熱門排行榜前10名",
+    }[intent]
+    response = _create_completion(
+        f"structured:{intent}",
+        model="gpt-4o-search-preview",
+        messages=[
+            {"role": "system", "content": render.system_prompt(intent, language)},
+            {"role": "user", "content": user_content}
+        ],
+        max_tokens=render.MAX_TOKENS[intent],
+        web_search_options={"search_context_size": "medium"}
+    )
+
+    content = response.choices[0].message.content
+    # 不是有效 JSON 時拋出例外，由斷路器與舊回答備援處理，不寫入快取
+    return render.dumps(render.parse_record(content)) if content else content
+
+def _serve_structured(intent: str, query: str, user_id: str = None, language: str = None) -> str:
+    """取得結構化紀錄（依產品與範本語言快取）並以用戶語言套用範本"""
+    language = render.template_language(
+        language or (preferences.get_language(user_id) if user_id else None) or 'zh-tw'
+    )
+    return answer_cache.serve(
+        intent, query,
+        generate=lambda: _request_structured_answer(intent, query, language),
+        language=render.record_language(language),
+        render=lambda stored: render.render(intent, stored, language)
+    )
 
 # 修正後的功能：產品價格查詢（整合網路搜尋）
-def get_device_price(device_name: str, user_id: str = None) -> str:
-    """查詢設備價格資訊，整合網路搜尋結果"""
+def get_device_price(device_name: str, user_id: str = None, language: str = None) -> str:
+    """查詢設備價格資訊，上游失敗時改用快取的舊回答"""
+    try:
+        if structured_answer_enabled('price'):
+            return _serve_structured('price', device_name, user_id, language)
+        return answer_cache.serve(
+            'price', device_name,
+            generate=lambda: _request_device_price(device_name)
+        )
+    except rate_limit.REJECTIONS:
+        # 額度不足或排不到上游名額，由 handle_user_message 回覆忙碌訊息
+        raise
+    except Exception as e:
+        logger.error(f"價格查詢失敗: {e}")
+        return "抱歉，目前無法查詢價格資訊，請稍後再試。如需協助，請提供更具體的產品型號。"
+
+def _request_device_price(device_name: str, user_id: str = None) -> str:
+    """向 OpenAI 查詢設備價格資訊，整合網路搜尋結果"""
     conversation_history = []
     if user_id:
         history = get_conversation_history(user_id, 4)
@@ -168,28 +374,39 @@ def get_device_price(device_name: str, user_id: str = None) -> str:
         )
     }
     
+    # 組合搜尋結果和用戶問題
+    user_content = f"請查詢 {device_name} 的價格資訊"
+    messages = [system_message] + conversation_history + [
+        {"role": "user", "content": user_content}
+    ]
+    response = _create_completion(
+        "text:price",
+        model="gpt-4o-search-preview",
+        messages=messages,
+        max_tokens=1500,
+        web_search_options={"search_context_size": "medium"}
+    )
+
+    return response.choices[0].message.content
+
+# 原有功能：3C產品規格查詢（整合網路搜尋）
+def get_3c_product_info(product_name: str, user_id: str = None, language: str = None) -> str:
+    """查詢3C產品詳細規格資訊，上游失敗時改用快取的舊回答"""
     try:
-        # 組合搜尋結果和用戶問題
-        user_content = f"請查詢 {device_name} 的價格資訊"
-        messages = [system_message] + conversation_history + [
-            {"role": "user", "content": user_content}
-        ]
-        response = client.chat.completions.create(
-            model="gpt-4o-search-preview",
-            messages=messages,
-            max_tokens=1500,
-            web_search_options={"search_context_size": "medium"}
+        if structured_answer_enabled('spec'):
+            return _serve_structured('spec', product_name, user_id, language)
+        return answer_cache.serve(
+            'spec', product_name,
+            generate=lambda: _request_3c_product_info(product_name)
         )
-        
-        return response.choices[0].message.content
-        
+    except rate_limit.REJECTIONS:
+        raise
     except Exception as e:
-        logger.error(f"價格查詢失敗: {e}")
-        return "抱歉，目前無法查詢價格資訊，請稍後再試。如需協助，請提供更具體的產品型號。"
+        logger.error(f"產品資訊查詢失敗: {e}")
+        return "抱歉，目前無法取得產品資訊，請稍後再試。建議您：\n1. 確認產品名稱是否正確\n2. 稍後重新查詢\n3. 聯繫客服取得協助"
 
-# 原有功能：3C產品規格查詢（整合網路搜尋）
-def get_3c_product_info(product_name: str, user_id: str = None) -> str:
-    """查詢3C產品詳細規格資訊，整合網路搜尋結果"""
+def _request_3c_product_info(product_name: str, user_id: str = None) -> str:
+    """向 OpenAI 查詢3C產品詳細規格資訊，整合網路搜尋結果"""
     conversation_history = []
     if user_id:
         history = get_conversation_history(user_id, 4)
@@ -213,28 +430,37 @@ def get_3c_product_info(product_name: str, user_id: str = None) -> str:
         )
     }
     
+    # 組合搜尋結果和用戶問題
+    user_content = f"請提供 {product_name} 的詳細規格資訊"
+    messages = [system_message] + conversation_history + [
+        {"role": "user", "content": user_content}
+    ]
+    response = _create_completion(
+        "text:spec",
+        model="gpt-4o-search-preview",
+        messages=messages,
+        max_tokens=1500,
+        web_search_options={"search_context_size": "medium"}
+    )
+
+    return response.choices[0].message.content
+
+# 原有功能：產品比較（整合網路搜尋）
+def compare_devices(device1: str, device2: str, user_id: str = None) -> str:
+    """比較兩個設備的功能和規格，上游失敗時改用快取的舊回答"""
     try:
-        # 組合搜尋結果和用戶問題
-        user_content = f"請提供 {product_name} 的詳細規格資訊"
-        messages = [system_message] + conversation_history + [
-            {"role": "user", "content": user_content}
-        ]
-        response = client.chat.completions.create(
-            model="gpt-4o-search-preview",
-            messages=messages,
-            max_tokens=1500,
-            web_search_options={"search_context_size": "medium"}
+        return answer_cache.serve(
+            'compare', f"{device1} vs {device2}",
+            generate=lambda: _request_device_comparison(device1, device2)
         )
-        
-        return response.choices[0].message.content
-        
+    except rate_limit.REJECTIONS:
+        raise
     except Exception as e:
-        logger.error(f"產品資訊查詢失敗: {e}")
-        return "抱歉，目前無法取得產品資訊，請稍後再試。建議您：\n1. 確認產品名稱是否正確\n2. 稍後重新查詢\n3. 聯繫客服取得協助"
+        logger.error(f"產品比較失敗: {e}")
+        return "抱歉，目前無法進行產品比較，請稍後再試或提供更具體的產品型號。"
 
-# 原有功能：產品比較（整合網路搜尋）
-def compare_devices(device1: str, device2: str, user_id: str = None) -> str:
-    """比較兩個設備的功能和規格，整合網路搜尋結果"""
+def _request_device_comparison(device1: str, device2: str, user_id: str = None) -> str:
+    """向 OpenAI 比較兩個設備的功能和規格，整合網路搜尋結果"""
     conversation_history = []
     if user_id:
         history = get_conversation_history(user_id, 4)
@@ -259,40 +485,70 @@ def compare_devices(device1: str, device2: str, user_id: str = None) -> str:
         )
     }
     
+    # 組合所有搜尋結果
+    user_content = f"請比較 {device1} 和 {device2} 的差異"
+    messages = [system_message] + conversation_history + [
+        {"role": "user", "content": user_content}
+    ]
+    response = client.chat.completions.create(
+        model="gpt-4o-search-preview",
+        messages=messages,
+        max_tokens=1500,
+        web_search_options={"search_context_size": "medium"}
+    )
+
+    return response.choices[0].message.content
+
+# 原有功能：升級推薦（整合網路搜尋）
+# 非預設語言的回答指示
+LANGUAGE_INSTRUCTIONS = {
+    'en': "請以英文回答。",
+    'ja': "請以日文回答。",
+    'ko': "請以韓文回答。"
+}
+
+def describe_preferences(user_input: str, preference: Optional[Dict]) -> str:
+    """將已知偏好整理成簡短提示，訊息中已提到的項目不重複"""
+    if not preference:
+        return ""
+    
+    hints = []
+    if preference.get('budget_range') and not preferences.extract_budget(user_input):
+        hints.append(f"預算約 {int(preference['budget_range']):,} 元")
+    if preference.get('preferred_brands') and not preferences.extract_brands(user_input):
+        hints.append(f"偏好品牌 {'、'.join(preference['preferred_brands'])}")
+    hint = f"（使用者偏好：{'；'.join(hints)}）" if hints else ""
+    return hint + LANGUAGE_INSTRUCTIONS.get(preference.get('preferred_language'), "")
+
+def get_upgrade_recommendation_single(user_input: str, user_id: str = None) -> str:
+    """根據用戶需求與已知偏好提供升級推薦，上游失敗時改用快取的舊回答"""
+    preference_hint = describe_preferences(user_input, preferences.get(user_id)) if user_id else ""
     try:
-        # 組合所有搜尋結果
-        user_content = f"請比較 {device1} 和 {device2} 的差異"
-        messages = [system_message] + conversation_history + [
-            {"role": "user", "content": user_content}
-        ]
-        response = client.chat.completions.create(
-            model="gpt-4o-search-preview",
-            messages=messages,
-            max_tokens=1500,
-            web_search_options={"search_context_size": "medium"}
+        return answer_cache.serve(
+            'recommend', f"{user_input}{preference_hint}",
+            generate=lambda: _request_upgrade_recommendation(user_input, preference_hint=preference_hint)
         )
-        
-        return response.choices[0].message.content
-        
+    except rate_limit.REJECTIONS:
+        raise
     except Exception as e:
-        logger.error(f"產品比較失敗: {e}")
-        return "抱歉，目前無法進行產品比較，請稍後再試或提供更具體的產品型號。"
+        logger.error(f"升級推薦失敗: {e}")
+        return "抱歉，目前無法提供升級推薦，請稍後再試。建議您提供更詳細的需求描述以獲得更精準的推薦。"
 
-# 原有功能：升級推薦（整合網路搜尋）
-def get_upgrade_recommendation_single(user_input: str, user_id: str = None) -> str:
-    """根據用戶需求提供升級推薦，整合網路搜尋結果"""
+def _request_upgrade_recommendation(user_input: str, user_id: str = None, preference_hint: str = "") -> str:
+    """向 OpenAI 取得升級推薦，整合網路搜尋結果"""
     conversation_history = []
     if user_id:
-        history = get_conversation_history(user_id, 4)
+        # 已有偏好提示時，只需要較短的對話歷史
+        history = get_conversation_history(user_id, 2 if preference_hint else 4)
         conversation_history = [{"role": msg["role"], "content": msg["content"]} for msg in history]
     
-    # 搜尋推薦相關資訊
-    search_context = search_web(f"{user_input} 推薦 2024", 5)
+    # 搜尋推薦相關資訊（search_web 尚未實作，改由模型內建的網路搜尋）
+    #search_context = search_web(f"{user_input} 推薦 2024", 5)
     recommendation_context = ""
-    if search_context:
-        recommendation_context = "最新推薦資訊："
-        for result in search_context:
-            recommendation_context += f"- {result['title']}: {result['snippet']}\n"
+    #if search_context:
+    #    recommendation_context = "最新推薦資訊："
+    #    for result in search_context:
+    #        recommendation_context += f"- {result['title']}: {result['snippet']}\n"
     
     system_message = {
         "role": "system",
@@ -311,31 +567,41 @@ def get_upgrade_recommendation_single(user_input: str, user_id: str = None) -> s
         )
     }
     
+    # 組合搜尋結果、偏好和用戶問題
+    user_content = f"{user_input}{preference_hint}{recommendation_context}"
+
+    messages = [system_message] + conversation_history + [
+        {"role": "user", "content": user_content}
+    ]
+
+    response = client.chat.completions.create(
+        model="gpt-4o-search-preview",
+        messages=messages,
+        max_tokens=1500,
+        temperature=0.3,
+        web_search_options={"search_context_size": "medium"}
+    )
+
+    return response.choices[0].message.content
+
+# 原有功能：熱門排行榜（整合網路搜尋）
+def get_popular_ranking(category: str, user_id: str = None, language: str = None) -> str:
+    """取得熱門產品排行榜，上游失敗時改用快取的舊回答"""
     try:
-        # 組合搜尋結果和用戶問題
-        user_content = f"{user_input}{recommendation_context}"
-        
-        messages = [system_message] + conversation_history + [
-            {"role": "user", "content": user_content}
-        ]
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-search-preview",
-            messages=messages,
-            max_tokens=1500,
-            temperature=0.3,
-            web_search_options={"search_context_size": "medium"}
+        if structured_answer_enabled('ranking'):
+            return _serve_structured('ranking', category, user_id, language)
+        return answer_cache.serve(
+            'ranking', category,
+            generate=lambda: _request_popular_ranking(category)
         )
-        
-        return response.choices[0].message.content
-        
+    except rate_limit.REJECTIONS:
+        raise
     except Exception as e:
-        logger.error(f"升級推薦失敗: {e}")
-        return "抱歉，目前無法提供升級推薦，請稍後再試。建議您提供更詳細的需求描述以獲得更精準的推薦。"
+        logger.error(f"排行榜查詢失敗: {e}")
+        return "抱歉，目前無法取得排行榜資訊，請稍後再試或指定更具體的產品類別。"
 
-# 原有功能：熱門排行榜（整合網路搜尋）
-def get_popular_ranking(category: str, user_id: str = None) -> str:
-    """取得熱門產品排行榜，整合網路搜尋結果"""
+def _request_popular_ranking(category: str, user_id: str = None) -> str:
+    """向 OpenAI 取得熱門產品排行榜，整合網路搜尋結果"""
     conversation_history = []
     if user_id:
         history = get_conversation_history(user_id, 4)
@@ -365,31 +631,40 @@ def get_popular_ranking(category: str, user_id: str = None) -> str:
         )
     }
     
+    # 組合搜尋結果和用戶問題
+    user_content = f"請提供 {category} 的熱門排行榜{ranking_context}"
+
+    messages = [system_message] + conversation_history + [
+        {"role": "user", "content": user_content}
+    ]
+
+    response = _create_completion(
+        "text:ranking",
+        model="gpt-4o-search-preview",
+        messages=messages,
+        max_tokens=1500,
+        temperature=0.3,
+        web_search_options={"search_context_size": "medium"}
+    )
+
+    return response.choices[0].message.content
+
+# 原有功能：產品評價彙整（整合網路搜尋）
+def get_product_reviews(product_name: str, user_id: str = None) -> str:
+    """彙整產品評價和使用心得，上游失敗時改用快取的舊回答"""
     try:
-        # 組合搜尋結果和用戶問題
-        user_content = f"請提供 {category} 的熱門排行榜{ranking_context}"
-        
-        messages = [system_message] + conversation_history + [
-            {"role": "user", "content": user_content}
-        ]
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-search-preview",
-            messages=messages,
-            max_tokens=1500,
-            temperature=0.3,
-            web_search_options={"search_context_size": "medium"}
+        return answer_cache.serve(
+            'review', product_name,
+            generate=lambda: _request_product_reviews(product_name)
         )
-        
-        return response.choices[0].message.content
-        
+    except rate_limit.REJECTIONS:
+        raise
     except Exception as e:
-        logger.error(f"排行榜查詢失敗: {e}")
-        return "抱歉，目前無法取得排行榜資訊，請稍後再試或指定更具體的產品類別。"
+        logger.error(f"評價彙整失敗: {e}")
+        return "抱歉，目前無法取得評價資訊，請稍後再試或提供更具體的產品型號。"
 
-# 原有功能：產品評價彙整（整合網路搜尋）
-def get_product_reviews(product_name: str, user_id: str = None) -> str:
-    """彙整產品評價和使用心得，整合網路搜尋結果"""
+def _request_product_reviews(product_name: str, user_id: str = None) -> str:
+    """向 OpenAI 彙整產品評價和使用心得，整合網路搜尋結果"""
     conversation_history = []
     if user_id:
         history = get_conversation_history(user_id, 4)
@@ -420,30 +695,29 @@ def get_product_reviews(product_name: str, user_id: str = None) -> str:
         )
     }
     
-    try:
-        # 組合搜尋結果和用戶問題
-        user_content = f"請彙整 {product_name} 的評價和使用心得"
-        
-        messages = [system_message] + conversation_history + [
-            {"role": "user", "content": user_content}
-        ]
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-search-preview",
-            messages=messages,
-            max_tokens=1500,
-            web_search_options={"search_context_size": "medium"}
-        )
-        
-        return response.choices[0].message.content
-        
-    except Exception as e:
-        logger.error(f"評價彙整失敗: {e}")
-        return "抱歉，目前無法取得評價資訊，請稍後再試或提供更具體的產品型號。"
+    # 組合搜尋結果和用戶問題
+    user_content = f"請彙整 {product_name} 的評價和使用心得"
+
+    messages = [system_message] + conversation_history + [
+        {"role": "user", "content": user_content}
+    ]
+
+    response = client.chat.completions.create(
+        model="gpt-4o-search-preview",
+        messages=messages,
+        max_tokens=1500,
+        web_search_options={"search_context_size": "medium"}
+    )
+
+    return response.choices[0].message.content
 
 # 語言偵測功能
 def detect_language(text: str) -> str:
     """偵測文字語言"""
+    # 含中日韓字元時以字元種類為準；langdetect 常把「iPhone 15 價格」這類混合文字判成英文
+    script = preferences.script_language(text)
+    if script:
+        return script
     try:
         # 移除特殊字符和數字，只保留字母
         clean_text = re.sub(r'[^\w\s]', '', text)
@@ -467,29 +741,135 @@ def detect_language(text: str) -> str:
         return 'zh-tw'
 
 # 購物車功能
+# 各通路價格欄位與最低價運算式（忽略沒有報價的通路）
+STORE_PRICE_COLUMNS = {
+    'pchome': 'pchome_price',
+    'momo': 'momo_price',
+    'shopee': 'shopee_price'
+}
+CHEAPEST_PRICE_SQL = (
+    'NULLIF(MIN(COALESCE(p.pchome_price, 1e308), COALESCE(p.momo_price, 1e308), '
+    'COALESCE(p.shopee_price, 1e308)), 1e308)'
+)
+
+def _upsert_cart_row(cursor, user_id: str, product_name: str, quantity: int, accumulate: bool = True):
+    """
+    以正規化名稱新增商品，已存在時累加（或設定）數量並更新異動時間（不提交交易）
+    新增時連結產品資料表記錄當下最低價
+    """
+    new_quantity = 'quantity + excluded.quantity' if accumulate else 'excluded.quantity'
+    cursor.execute(f'''
+        INSERT INTO cart (user_id, product, product_key, quantity, product_id, price, updated_at)
+        SELECT ?, ?, ?, ?, p.id, {CHEAPEST_PRICE_SQL}, CURRENT_TIMESTAMP
+        FROM (SELECT 1) LEFT JOIN products p ON p.name = ? COLLATE NOCASE
+        WHERE true
+        LIMIT 1
+        ON CONFLICT(user_id, product_key) DO UPDATE SET
+            quantity = {new_quantity},
+            updated_at = excluded.updated_at
+    ''', (user_id, product_name, answer_cache.normalize_query(product_name), quantity, product_name))
+
+def _cart_match_candidates(cursor, user_id: str) -> List[Tuple[str, str, frozenset]]:
+    """
+    取得用戶購物車的 (正規化名稱, 商品名稱, 型號英數字)，依購物車版本快取；
+    交易中已有未提交的異動（批次操作）時直接查詢，不使用也不寫入快取
+    """
+    use_cache = not cursor.connection.in_transaction
+    if use_cache:
+        cursor.execute('SELECT version FROM cart_versions WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        version = row[0] if row else 0
+        cached = cart_match_cache.get(user_id)
+        if cached and cached[0] == version:
+            return cached[1]
+    
+    cursor.execute('SELECT product_key, product FROM cart WHERE user_id = ?', (user_id,))
+    candidates = [(key, product, similarity.guard_tokens(key)) for key, product in cursor.fetchall()]
+    if use_cache:
+        cart_match_cache[user_id] = (version, candidates)
+    return candidates
+
+def _match_cart_product(cursor, user_id: str, product_key: str) -> Optional[Tuple[str, str]]:
+    """
+    名稱不完全相同時，找出最接近的商品（型號英數字須相同）
+    有兩個以上接近的商品時不猜測，回傳 None
+    """
+    guard = similarity.guard_tokens(product_key)
+    scored = sorted((
+        (difflib.SequenceMatcher(None, product_key, key).ratio(), key, product)
+        for key, product, candidate_guard in _cart_match_candidates(cursor, user_id)
+        if candidate_guard == guard
+    ), reverse=True)
+    if not scored or scored[0][0] < CART_MATCH_THRESHOLD:
+        return None
+    if len(scored) > 1 and scored[0][0] - scored[1][0] < CART_MATCH_MARGIN:
+        return None
+    return scored[0][1], scored[0][2]
+
+def _delete_cart_row(cursor, user_id: str, product_name: str) -> Optional[str]:
+    """依正規化名稱刪除商品，必要時改用近似比對，回傳被移除的商品名稱（不提交交易）"""
+    product_key = answer_cache.normalize_query(product_name)
+    cursor.execute('SELECT product FROM cart WHERE user_id = ? AND product_key = ?', (user_id, product_key))
+    row = cursor.fetchone()
+    if row:
+        removed = row[0]
+    else:
+        match = _match_cart_product(cursor, user_id, product_key)
+        if match is None:
+            return None
+        product_key, removed = match
+    
+    cursor.execute('DELETE FROM cart WHERE user_id = ? AND product_key = ?', (user_id, product_key))
+    return removed if cursor.rowcount else None
+
+def _bump_cart_version(cursor, user_id: str) -> int:
+    """遞增用戶的購物車版本（不提交交易）"""
+    cursor.execute('''
+        INSERT INTO cart_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+    ''', (user_id,))
+    cursor.execute('SELECT version FROM cart_versions WHERE user_id = ?', (user_id,))
+    return cursor.fetchone()[0]
+
+def _remember_cart_version(user_id: str, version: int):
+    """記錄最新的購物車版本"""
+    cart_version_cache[user_id] = (version, datetime.now().timestamp())
+
+def _cached_cart_version(user_id: str) -> Optional[int]:
+    """取得記憶體中仍有效的購物車版本"""
+    cached = cart_version_cache.get(user_id)
+    if cached and datetime.now().timestamp() - cached[1] < CART_VERSION_TTL:
+        return cached[0]
+    return None
+
+def get_cart_version(user_id: str) -> int:
+    """取得購物車版本，快取有效時不查詢資料庫"""
+    cached_version = _cached_cart_version(user_id)
+    if cached_version is not None:
+        return cached_version
+    
+    conn = sqlite3.connect('bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute('SELECT version FROM cart_versions WHERE user_id = ?', (user_id,))
+    row = cursor.fetchone()
+    conn.close()
+    
+    version = row[0] if row else 0
+    _remember_cart_version(user_id, version)
+    return version
+
 def add_to_cart(user_id: str, product_name: str, quantity: int = 1) -> bool:
     """新增商品至購物車"""
     try:
         conn = sqlite3.connect('bot_data.db')
         cursor = conn.cursor()
         
-        # 檢查是否已存在
-        cursor.execute('SELECT id, quantity FROM cart WHERE user_id = ? AND product = ?', 
-                      (user_id, product_name))
-        existing = cursor.fetchone()
-        
-        if existing:
-            # 更新數量
-            new_quantity = existing[1] + quantity
-            cursor.execute('UPDATE cart SET quantity = ? WHERE id = ?', 
-                          (new_quantity, existing[0]))
-        else:
-            # 新增商品
-            cursor.execute('INSERT INTO cart (user_id, product, quantity) VALUES (?, ?, ?)', 
-                          (user_id, product_name, quantity))
+        _upsert_cart_row(cursor, user_id, product_name, quantity)
+        version = _bump_cart_version(cursor, user_id)
         
         conn.commit()
         conn.close()
+        _remember_cart_version(user_id, version)
         return True
     except Exception as e:
         logger.error(f"新增至購物車失敗: {e}")
@@ -515,66 +895,251 @@ def get_cart_items(user_id: str) -> List[Dict]:
         logger.error(f"取得購物車失敗: {e}")
         return []
 
-def remove_from_cart(user_id: str, product_name: str) -> bool:
-    """從購物車移除商品"""
+def get_cart_page(user_id: str, after_id: int = 0, limit: int = 50) -> Tuple[List[Dict], Optional[int]]:
+    """以游標分頁取得購物車商品，回傳商品與下一頁游標"""
+    conn = sqlite3.connect('bot_data.db')
+    cursor = conn.cursor()
+    
+    # 多取一筆判斷是否還有下一頁
+    cursor.execute(
+        'SELECT id, product, quantity, price, added_time FROM cart WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?',
+        (user_id, after_id, limit + 1)
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return [{
+        'id': row[0],
+        'product': row[1],
+        'quantity': row[2],
+        'price': row[3],
+        'added_time': row[4]
+    } for row in rows[:limit]], next_cursor
+
+def get_cart_summary(user_id: str) -> Dict:
+    """
+    以單一查詢取得購物車商品、加入時價格合計、目前最低價合計與各通路合計，
+    結果依購物車版本快取。合計只包含有價格的商品，*_priced_items 為計入的商品數
+    """
+    cached_version = _cached_cart_version(user_id)
+    cached = cart_summary_cache.get(user_id)
+    if cached_version is not None and cached and cached[0] == cached_version:
+        return cached[1]
+    
+    store_columns = ''.join(
+        f"SUM(c.quantity * p.{column}) OVER (), COUNT(p.{column}) OVER (), "
+        for column in STORE_PRICE_COLUMNS.values()
+    )
+    conn = sqlite3.connect('bot_data.db')
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT c.product, c.quantity, c.price, {CHEAPEST_PRICE_SQL} AS cheapest,
+               CASE {CHEAPEST_PRICE_SQL}
+                   WHEN p.pchome_price THEN 'pchome'
+                   WHEN p.momo_price THEN 'momo'
+                   WHEN p.shopee_price THEN 'shopee'
+               END,
+               SUM(c.quantity) OVER (),
+               SUM(c.quantity * c.price) OVER (), COUNT(c.price) OVER (),
+               SUM(c.quantity * {CHEAPEST_PRICE_SQL}) OVER (), COUNT({CHEAPEST_PRICE_SQL}) OVER (),
+               {store_columns}
+               (SELECT version FROM cart_versions WHERE user_id = c.user_id)
+        FROM cart c LEFT JOIN products p ON p.id = c.product_id
+        WHERE c.user_id = ?
+        ORDER BY c.id
+    ''', (user_id,))
+    rows = cursor.fetchall()
+    conn.close()
+    
+    summary = {
+        'items': [{
+            'product': row[0],
+            'quantity': row[1],
+            'price': row[2],
+            'cheapest_price': row[3],
+            'cheapest_store': row[4]
+        } for row in rows],
+        'total_quantity': rows[0][5] if rows else 0,
+        'snapshot_total': rows[0][6] if rows else None,
+        'snapshot_priced_items': rows[0][7] if rows else 0,
+        'cheapest_total': rows[0][8] if rows else None,
+        'cheapest_priced_items': rows[0][9] if rows else 0,
+        'store_totals': {
+            store: {
+                'total': rows[0][10 + index * 2],
+                'items': rows[0][11 + index * 2]
+            } if rows else {'total': None, 'items': 0}
+            for index, store in enumerate(STORE_PRICE_COLUMNS)
+        }
+    }
+    
+    if rows:
+        version = rows[0][-1] or 0
+        _remember_cart_version(user_id, version)
+        cart_summary_cache[user_id] = (version, summary)
+    return summary
+
+def remove_from_cart(user_id: str, product_name: str) -> Optional[str]:
+    """從購物車移除商品，回傳實際移除的商品名稱，找不到時回傳 None"""
     try:
         conn = sqlite3.connect('bot_data.db')
         cursor = conn.cursor()
         
-        cursor.execute('DELETE FROM cart WHERE user_id = ? AND product = ?', 
-                      (user_id, product_name))
-        
-        affected_rows = cursor.rowcount
+        removed = _delete_cart_row(cursor, user_id, product_name)
+        if removed:
+            version = _bump_cart_version(cursor, user_id)
         conn.commit()
         conn.close()
         
-        return affected_rows > 0
+        if removed:
+            _remember_cart_version(user_id, version)
+        return removed
     except Exception as e:
         logger.error(f"從購物車移除失敗: {e}")
+        return None
+
+def clear_cart(user_id: str) -> bool:
+    """清空購物車"""
+    try:
+        conn = sqlite3.connect('bot_data.db')
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
+        version = _bump_cart_version(cursor, user_id)
+        
+        conn.commit()
+        conn.close()
+        _remember_cart_version(user_id, version)
+        return True
+    except Exception as e:
+        logger.error(f"清空購物車失敗: {e}")
         return False
 
+def apply_cart_operations(user_id: str, operations: List[Dict]) -> int:
+    """
+    在同一個交易中批次處理購物車異動，回傳新的購物車版本
+    operations 每筆包含 action（add / remove / update）、product_name 與 quantity；
+    任一筆不合法（包含移除購物車中沒有的商品）時拋出 ValueError，整批都不會寫入
+    """
+    conn = sqlite3.connect('bot_data.db')
+    try:
+        cursor = conn.cursor()
+        
+        for operation in operations:
+            action = operation.get('action')
+            product_name = operation.get('product_name')
+            quantity = int(operation.get('quantity', 1))
+            
+            if not product_name:
+                raise ValueError('缺少商品名稱')
+            
+            if action == 'add':
+                if quantity <= 0:
+                    raise ValueError(f'數量不正確: {product_name}')
+                _upsert_cart_row(cursor, user_id, product_name, quantity)
+            elif action == 'remove' or (action == 'update' and quantity <= 0):
+                if _delete_cart_row(cursor, user_id, product_name) is None:
+                    raise ValueError(f'購物車中沒有此商品: {product_name}')
+            elif action == 'update':
+                _upsert_cart_row(cursor, user_id, product_name, quantity, accumulate=False)
+            else:
+                raise ValueError(f'不支援的操作: {action}')
+        
+        version = _bump_cart_version(cursor, user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    _remember_cart_version(user_id, version)
+    return version
+
 # 意圖識別和回應處理
-def detect_intent_and_respond(user_input: str, user_id: str) -> str:
-    """智能識別用戶意圖並提供對應回應"""
+# 依序比對，第一個符合的意圖優先
+INTENT_KEYWORDS = [
+    ('price', ['價格', '多少錢', 'price', '售價', '報價']),
+    ('compare', ['比較', 'vs', '對比', 'compare', '差別', '差異']),
+    ('recommend', ['推薦', '建議', 'recommend', '選擇', '買什麼']),
+    ('ranking', ['排行榜', '排名', 'ranking', '熱門', '暢銷']),
+    ('review', ['評價', '評測', 'review', '心得', '使用感想']),
+    ('spec', ['規格', '參數', 'spec', '配置', '詳細資訊'])
+]
+
+def detect_intent(user_input: str) -> str:
+    """依關鍵字識別用戶意圖，沒有明確意圖時回傳 general"""
     user_input_lower = user_input.lower()
+    for intent, keywords in INTENT_KEYWORDS:
+        if any(keyword in user_input_lower for keyword in keywords):
+            return intent
+    return 'general'
+
+# 熱門查詢預熱使用的回答產生函式（推薦含個人偏好，不預熱）
+hot_queries.register_warmer('price', _request_device_price)
+hot_queries.register_warmer('spec', _request_3c_product_info)
+hot_queries.register_warmer('compare', lambda query: _request_device_comparison(*query.split(' vs ', 1)))
+hot_queries.register_warmer('ranking', _request_popular_ranking)
+hot_queries.register_warmer('review', _request_product_reviews)
+for structured_intent in render.STRUCTURED_INTENTS:
+    if structured_answer_enabled(structured_intent):
+        hot_queries.register_warmer(
+            structured_intent,
+            lambda query, intent=structured_intent: _request_structured_answer(intent, query),
+            render.RECORD_LANGUAGE
+        )
+
+def detect_intent_and_respond(user_input: str, user_id: str, language: str = None) -> str:
+    """智能識別用戶意圖並提供對應回應（language 為這則訊息偵測到的語言）"""
+    # 訊息含漢字時一律用繁中範本與共用的 record 紀錄，不因偏好或誤判改用英文範本而多存一份、多一次上游呼叫
+    language = preferences.script_language(user_input) or language
+    intent = detect_intent(user_input)
+    profiling.tag(intent)
     
     # 價格查詢意圖
-    if any(keyword in user_input_lower for keyword in ['價格', '多少錢', 'price', '售價', '報價']):
+    if intent == 'price':
         product_name = extract_product_name(user_input)
         if product_name:
-            return get_device_price(product_name, user_id)
+            hot_queries.record('price', product_name)
+            return get_device_price(product_name, user_id, language)
     
     # 產品比較意圖
-    elif any(keyword in user_input_lower for keyword in ['比較', 'vs', '對比', 'compare', '差別', '差異']):
+    elif intent == 'compare':
         products = extract_comparison_products(user_input)
         if len(products) >= 2:
+            hot_queries.record('compare', f"{products[0]} vs {products[1]}")
             return compare_devices(products[0], products[1], user_id)
     
     # 推薦意圖
-    elif any(keyword in user_input_lower for keyword in ['推薦', '建議', 'recommend', '選擇', '買什麼']):
+    elif intent == 'recommend':
         return get_upgrade_recommendation_single(user_input, user_id)
     
     # 排行榜意圖
-    elif any(keyword in user_input_lower for keyword in ['排行榜', '排名', 'ranking', '熱門', '暢銷']):
-        category = extract_product_category(user_input)
-        return get_popular_ranking(category or '3C產品', user_id)
+    elif intent == 'ranking':
+        category = extract_product_category(user_input) or '3C產品'
+        hot_queries.record('ranking', category)
+        return get_popular_ranking(category, user_id, language)
     
     # 評價意圖
-    elif any(keyword in user_input_lower for keyword in ['評價', '評測', 'review', '心得', '使用感想']):
+    elif intent == 'review':
         product_name = extract_product_name(user_input)
         if product_name:
+            hot_queries.record('review', product_name)
             return get_product_reviews(product_name, user_id)
     
     # 規格查詢意圖
-    elif any(keyword in user_input_lower for keyword in ['規格', '參數', 'spec', '配置', '詳細資訊']):
+    elif intent == 'spec':
         product_name = extract_product_name(user_input)
         if product_name:
-            return get_3c_product_info(product_name, user_id)
+            hot_queries.record('spec', product_name)
+            return get_3c_product_info(product_name, user_id, language)
     
     # 如果沒有明確意圖，使用通用3C產品查詢
     product_name = extract_product_name(user_input)
     if product_name:
-        return get_3c_product_info(product_name, user_id)
+        hot_queries.record('spec', product_name)
+        return get_3c_product_info(product_name, user_id, language)
     
     # 使用GPT處理其他對話
     return handle_follow_up_question(user_input, user_id)
@@ -667,19 +1232,27 @@ def handle_follow_up_question(user_input: str, user_id: str) -> str:
         user_content = f"{user_input}{web_context}"
         messages.append({"role": "user", "content": user_content})
         
-        response = client.chat.completions.create(
+        response = rate_limit.call_upstream(lambda: client.chat.completions.create(
             model="gpt-4o-search-preview",
             messages=messages,
             max_tokens=1500,
             web_search_options={"search_context_size": "medium"}
-        )
+        ))
         
         return response.choices[0].message.content
         
+    except rate_limit.REJECTIONS:
+        raise
     except Exception as e:
         logger.error(f"追加提問處理失敗: {e}")
         return "抱歉，我無法理解您的問題。請嘗試詢問3C產品相關的問題，例如產品規格、價格比較或購買建議。"
 
+def _partial_total_note(priced_items: int, item_count: int) -> str:
+    """部分商品沒有價格時，標示合計只涵蓋其中幾項"""
+    if priced_items >= item_count:
+        return ""
+    return f"（僅 {priced_items}/{item_count} 項有價格，未含其餘商品）"
+
 # 指令解析功能
 def parse_command(user_input: str, user_id: str, detected_language: str) -> str:
     """解析用戶指令"""
@@ -699,12 +1272,32 @@ def parse_command(user_input: str, user_id: str, detected_language: str) -> str:
             return "⚠️ 請在指令後提供商品名稱，例如：新增至購物車 iPhone 13"
     
     elif any(keyword in user_input_lower for keyword in ['顯示購物車', 'show cart', '我的購物車']):
-        items = get_cart_items(user_id)
-        if items:
-            cart_text = "🛒 您的購物車：\n"
-            for i, item in enumerate(items, 1):
-                cart_text += f"{i}. {item['product']} (數量: {item['quantity']})\n"
-            return cart_text
+        try:
+            summary = get_cart_summary(user_id)
+        except Exception as e:
+            logger.error(f"取得購物車失敗: {e}")
+            return "❌ 取得購物車失敗，請稍後再試"
+        
+        if summary['items']:
+            lines = ["🛒 您的購物車："]
+            for i, item in enumerate(summary['items'], 1):
+                line = f"{i}. {item['product']} (數量: {item['quantity']})"
+                if item['price'] is not None:
+                    line += f" 加入時 ${item['price']:,.0f}"
+                lines.append(line)
+            
+            item_count = len(summary['items'])
+            if summary['snapshot_total'] is not None:
+                lines.append(
+                    f"\n💰 加入時價格合計：${summary['snapshot_total']:,.0f}"
+                    + _partial_total_note(summary['snapshot_priced_items'], item_count)
+                )
+            if summary['cheapest_total'] is not None:
+                lines.append(
+                    f"📉 目前最低價合計：${summary['cheapest_total']:,.0f}"
+                    + _partial_total_note(summary['cheapest_priced_items'], item_count)
+                )
+            return "\n".join(lines)
         else:
             return "🛒 您的購物車目前是空的"
     
@@ -713,23 +1306,18 @@ def parse_command(user_input: str, user_id: str, detected_language: str) -> str:
         product_match = re.search(r'(?:移除|remove|刪除)\s+(.+)', user_input, re.IGNORECASE)
         if product_match:
             product_name = product_match.group(1).strip()
-            if remove_from_cart(user_id, product_name):
-                return f"❌ 已從您的購物車移除 {product_name}"
+            removed = remove_from_cart(user_id, product_name)
+            if removed:
+                return f"❌ 已從您的購物車移除 {removed}"
             else:
                 return f"⚠️ 找不到 {product_name} 在您的購物車中，請確認名稱是否正確"
         else:
             return "⚠️ 請指定要移除的商品名稱"
     
     elif any(keyword in user_input_lower for keyword in ['清空購物車', 'clear cart']):
-        try:
-            conn = sqlite3.connect('bot_data.db')
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM cart WHERE user_id = ?', (user_id,))
-            conn.commit()
-            conn.close()
+        if clear_cart(user_id):
             return "🗑️ 已清空您的購物車"
-        except Exception as e:
-            logger.error(f"清空購物車失敗: {e}")
+        else:
             return "❌ 清空購物車失敗，請稍後再試"
     
     elif any(keyword in user_input_lower for keyword in ['說明', 'help', '幫助']):
@@ -775,19 +1363,30 @@ def parse_command(user_input: str, user_id: str, detected_language: str) -> str:
         return help_messages.get(detected_language, help_messages['zh-tw'])
     
     elif any(keyword in user_input_lower for keyword in ['清除對話', 'clear conversation']):
-        if user_id in user_conversations:
-            user_conversations[user_id] = []
+        with conversations_lock:
+            user_conversations.pop(user_id, None)
         return "🗑️ 已清除對話歷史"
     
     # 如果不是特殊指令，返回 None 讓其他函數處理
     return None
 
+RATE_LIMITED_MESSAGE = "您的查詢太頻繁了，請稍等一下再試 🙏"
+
 # 主要訊息處理函數
 def handle_user_message(user_input: str, user_id: str) -> str:
     """處理用戶訊息的主函數"""
     try:
-        # 偵測語言
-        detected_language = detect_language(user_input)
+        # 每則訊息至少扣除便宜指令的額度
+        if not rate_limit.limiter.try_consume(user_id, rate_limit.COST_CHEAP):
+            return RATE_LIMITED_MESSAGE
+        
+        # 已知語言偏好的用戶通常略過語言偵測，字元種類不符或定期重新偵測時才偵測，並從訊息學習偏好
+        if preferences.language_check_due(user_id, user_input):
+            detected_language = detect_language(user_input)
+            preferences.learn(user_id, user_input, detected_language)
+        else:
+            detected_language = preferences.get_language(user_id)
+            preferences.learn(user_id, user_input)
         
         # 記錄用戶輸入
         add_to_conversation(user_id, 'user', user_input)
@@ -795,17 +1394,24 @@ def handle_user_message(user_input: str, user_id: str) -> str:
         # 先嘗試解析特殊指令（購物車、說明等）
         command_response = parse_command(user_input, user_id, detected_language)
         if command_response:
+            profiling.tag('command')
             add_to_conversation(user_id, 'assistant', command_response)
             return command_response
         
-        # 使用意圖識別處理一般對話
-        response = detect_intent_and_respond(user_input, user_id)
+        # 使用意圖識別處理一般對話；只有實際呼叫 OpenAI 時才補扣額度並排隊（快取命中不扣）
+        with rate_limit.acting_as(user_id):
+            response = detect_intent_and_respond(user_input, user_id, detected_language)
         
         # 記錄助手回應
         add_to_conversation(user_id, 'assistant', response)
         
         return response
         
+    except rate_limit.RateLimited:
+        return RATE_LIMITED_MESSAGE
+    except rate_limit.LoadShed as e:
+        logger.warning(f"系統忙碌，拒絕請求: {e}")
+        return "目前查詢人數較多，請稍等一下再試一次 🙏"
     except Exception as e:
         logger.error(f"處理用戶訊息失敗: {e}")
         return "抱歉，處理您的請求時發生錯誤，請稍後再試 🙏"
@@ -857,11 +1463,13 @@ def handle_message(event):
         user_input = event.message.text.strip()
         user_id = event.source.user_id
         
-        # 清理舊對話
+        # 清理舊對話與閒置的流量限制資料
         clear_old_conversations()
+        rate_limit.limiter.prune()
         
-        # 處理用戶訊息
-        response = handle_user_message(user_input, user_id)
+        # 處理用戶訊息（啟用效能分析時依抽樣率記錄）
+        with profiling.maybe_profile():
+            response = handle_user_message(user_input, user_id)
         
         # 回覆訊息
         line_bot_api.reply_message(
@@ -888,9 +1496,20 @@ try:
 except ImportError:
     logger.warning("Web routes not imported")
 
+def start_background_tasks():
+    """
+    啟動背景執行緒：資料庫維護、記憶體預算檢查、用戶偏好寫回與熱門查詢預熱
+    執行緒不會跟著 fork 複製，預先載入時需在每個 worker 中呼叫
+    """
+    maintenance.start_background_maintenance()
+    memory_budget.start_watchdog()
+    preferences.start_write_behind()
+    hot_queries.start_warmer()
+
 if __name__ == "__main__":
     # 初始化資料庫
     init_database()
+    start_background_tasks()
     
     # 啟動應用
     port = int(os.environ.get("PORT", 5000))
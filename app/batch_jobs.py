@@ -0,0 +1,259 @@
+# batch_jobs.py - 離線批次預先產生產品規格並存入回答快取
+#
+# 用法：python -m app.batch_jobs products.txt [--from-db] [--concurrency 4] [--checkpoint spec.ckpt]
+#       python -m app.batch_jobs products.txt --backend fake --db test.db   # 不呼叫 OpenAI，測試流程用
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional
+
+try:
+    from . import answer_cache, render
+except ImportError:
+    import answer_cache
+    import render
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+BATCH_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 2.0
+PROGRESS_INTERVAL_SECONDS = 10.0
+
+
+class FakeBackend:
+    """本地假後端：固定延遲與失敗率，不呼叫上游"""
+
+    language = 'zh-tw'
+
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def generate(self, product: str) -> str:
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise RuntimeError(f"假後端模擬失敗: {product}")
+        return f"{product} 規格（離線測試資料）"
+
+
+class OpenAIBackend:
+    """使用線上同一套提示向 OpenAI 產生規格（依 ANSWER_MODE 選擇文字或結構化）"""
+
+    def __init__(self):
+        try:
+            from . import app as bot
+        except ImportError:
+            import app as bot
+        self._bot = bot
+        self.structured = bot.structured_answer_enabled('spec')
+        self.language = render.record_language('zh-tw') if self.structured else 'zh-tw'
+
+    def generate(self, product: str) -> str:
+        if self.structured:
+            return self._bot._request_structured_answer('spec', product)
+        return self._bot._request_3c_product_info(product)
+
+
+BACKENDS = {
+    'openai': OpenAIBackend,
+    'fake': FakeBackend,
+}
+
+
+def load_products(path: Optional[str] = None, from_db: bool = False) -> List[str]:
+    """讀取產品清單（每行一個型號），可合併 products 資料表，去除重複"""
+    products = []
+    if path:
+        with open(path, encoding='utf-8') as f:
+            products.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    if from_db:
+        conn = sqlite3.connect(answer_cache.DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute('SELECT name FROM products ORDER BY id')
+        products.extend(row[0] for row in cursor.fetchall() if row[0])
+        conn.close()
+
+    seen = set()
+    unique = []
+    for product in products:
+        key = answer_cache.normalize_query(product)
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(product)
+    return unique
+
+
+def _read_checkpoint(path: Optional[str]) -> set:
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        return {answer_cache.normalize_query(line.rstrip('\n')) for line in f if line.strip()}
+
+
+class SpecBatchJob:
+    """以有限並行數批次產生規格，完成的產品寫入檢查點以便中斷後續跑"""
+
+    def __init__(self, backend, concurrency: int = BATCH_CONCURRENCY,
+                 checkpoint_path: Optional[str] = None, retries: int = BATCH_RETRIES,
+                 skip_fresh: bool = True):
+        self.backend = backend
+        self.concurrency = max(1, concurrency)
+        self.checkpoint_path = checkpoint_path
+        self.retries = retries
+        self.skip_fresh = skip_fresh
+        self._lock = threading.Lock()
+        self.stats = {'total': 0, 'skipped': 0, 'succeeded': 0, 'failed': 0, 'retries': 0}
+        self.failures: Dict[str, str] = {}
+
+    def _is_fresh(self, product: str) -> bool:
+        entry = answer_cache.get_entry('spec', product, self.backend.language)
+        return bool(entry) and time.time() - entry[1] < answer_cache.FRESH_TTL['spec']
+
+    def _process(self, product: str):
+        for attempt in range(self.retries + 1):
+            try:
+                answer = self.backend.generate(product)
+                if not answer:
+                    raise ValueError('後端回傳空白回答')
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                with self._lock:
+                    self.stats['retries'] += 1
+                logger.warning(f"{product} 第 {attempt + 1} 次失敗，稍後重試: {e}")
+                time.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt))
+
+        if not answer_cache.store_answer('spec', product, answer, self.backend.language):
+            raise RuntimeError('寫入回答快取失敗')
+
+    def _mark_done(self, checkpoint, product: str):
+        with self._lock:
+            self.stats['succeeded'] += 1
+            if checkpoint:
+                checkpoint.write(product + '\n')
+                checkpoint.flush()
+
+    def _report_progress(self, started: float):
+        elapsed = time.time() - started
+        with self._lock:
+            done = self.stats['succeeded'] + self.stats['failed']
+            pending = self.stats['total'] - self.stats['skipped'] - done
+            rate = done / elapsed if elapsed else 0.0
+            eta = pending / rate if rate else None
+            logger.info(
+                f"進度 {done}/{self.stats['total'] - self.stats['skipped']}，"
+                f"成功 {self.stats['succeeded']}，失敗 {self.stats['failed']}，"
+                f"{rate:.2f} 筆/秒" + (f"，預估剩餘 {eta:.0f} 秒" if eta is not None else "")
+            )
+
+    def run(self, products: Iterable[str]) -> Dict:
+        """執行批次作業並回傳統計"""
+        products = list(products)
+        done = _read_checkpoint(self.checkpoint_path)
+        self.stats['total'] = len(products)
+
+        todo = []
+        for product in products:
+            if answer_cache.normalize_query(product) in done or (self.skip_fresh and self._is_fresh(product)):
+                self.stats['skipped'] += 1
+            else:
+                todo.append(product)
+        logger.info(f"共 {len(products)} 項，略過 {self.stats['skipped']} 項（已完成或快取仍新鮮）")
+
+        started = time.time()
+        last_report = started
+        checkpoint = open(self.checkpoint_path, 'a', encoding='utf-8') if self.checkpoint_path else None
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                in_flight = {}
+                queue = iter(todo)
+                while True:
+                    # 最多同時排入兩倍並行數，避免一次建立大量 future
+                    while len(in_flight) < self.concurrency * 2:
+                        product = next(queue, None)
+                        if product is None:
+                            break
+                        in_flight[executor.submit(self._process, product)] = product
+                    if not in_flight:
+                        break
+
+                    finished, _ = wait(in_flight, timeout=PROGRESS_INTERVAL_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        product = in_flight.pop(future)
+                        error = future.exception()
+                        if error is None:
+                            self._mark_done(checkpoint, product)
+                        else:
+                            with self._lock:
+                                self.stats['failed'] += 1
+                                self.failures[product] = str(error)
+                            logger.error(f"{product} 產生失敗: {error}")
+
+                    if time.time() - last_report >= PROGRESS_INTERVAL_SECONDS:
+                        self._report_progress(started)
+                        last_report = time.time()
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+        elapsed = time.time() - started
+        processed = self.stats['succeeded'] + self.stats['failed']
+        report = dict(self.stats)
+        report['elapsed_seconds'] = round(elapsed, 2)
+        report['throughput_per_second'] = round(processed / elapsed, 3) if elapsed else 0.0
+        report['failures'] = self.failures
+        return report
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='批次預先產生產品規格並存入回答快取')
+    parser.add_argument('products', nargs='?', help='產品清單檔（每行一個型號，# 開頭為註解）')
+    parser.add_argument('--from-db', action='store_true', help='一併處理 products 資料表中的產品')
+    parser.add_argument('--db', help=f'資料庫路徑（預設 {answer_cache.DB_PATH}，假後端必須指定）')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='openai', help='產生回答的後端')
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY, help='同時處理的數量')
+    parser.add_argument('--retries', type=int, default=BATCH_RETRIES, help='每項失敗後的重試次數')
+    parser.add_argument('--checkpoint', help='檢查點檔案，重新執行時略過已完成的產品')
+    parser.add_argument('--force', action='store_true', help='快取仍新鮮的產品也重新產生')
+    parser.add_argument('--fake-failure-rate', type=float, default=0.0, help='假後端的模擬失敗率')
+    args = parser.parse_args(argv)
+
+    if not args.products and not args.from_db:
+        parser.error('請提供產品清單檔或 --from-db')
+    # 假後端的測試資料會被當成新鮮快取回覆給用戶，不可預設寫入正式資料庫
+    if args.backend == 'fake' and not args.db:
+        parser.error('假後端必須以 --db 指定測試用資料庫')
+
+    logging.basicConfig(level=logging.INFO)
+    answer_cache.DB_PATH = args.db or answer_cache.DB_PATH
+    # 產生回答前先確認可以寫入快取，避免付費產生的回答全部寫入失敗
+    schema_error = answer_cache.check_schema()
+    if schema_error:
+        parser.error(
+            f'無法寫入 {answer_cache.DB_PATH} 的回答快取（{schema_error}），'
+            '請先以 init_database() 建立資料庫（例如啟動一次應用程式）'
+        )
+    if args.backend == 'fake':
+        backend = FakeBackend(failure_rate=args.fake_failure_rate)
+    else:
+        backend = OpenAIBackend()
+
+    job = SpecBatchJob(
+        backend, concurrency=args.concurrency, checkpoint_path=args.checkpoint,
+        retries=args.retries, skip_fresh=not args.force
+    )
+    report = job.run(load_products(args.products, args.from_db))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,181 @@
+# export.py - 以串流方式匯出購物車、價格與查詢統計（NDJSON / CSV）
+#
+# 用法：python -m app.export cart [--format csv] [--since "2024-01-01 00:00:00"] [--output cart.ndjson]
+#       python -m app.export cart --watermark-file cart.wm   # 每晚增量匯出，自動讀寫水位
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'bot_data.db'
+
+# 每次從游標讀取的筆數，記憶體用量只與此有關，與資料表大小無關
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+# 水位上限比現在早幾秒，避免同一秒內尚未提交的資料在下次增量匯出時被略過
+WATERMARK_LAG_SECONDS = 2
+
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 可匯出的資料：watermark 為增量匯出依據的欄位，kind 為欄位格式
+# （timestamp 為 SQLite CURRENT_TIMESTAMP 文字，epoch 為 time.time() 秒數），皆為 UTC
+EXPORTS = {
+    'cart': {
+        'columns': ['id', 'user_id', 'product', 'quantity', 'price', 'product_id', 'added_time', 'updated_at'],
+        'table': 'cart',
+        # 數量變更也會更新 updated_at，增量匯出才看得到異動過的商品
+        'watermark': 'updated_at',
+        'kind': 'timestamp',
+    },
+    'prices': {
+        'columns': ['id', 'name', 'category', 'pchome_price', 'momo_price', 'shopee_price', 'last_updated'],
+        'table': 'products',
+        'watermark': 'last_updated',
+        'kind': 'timestamp',
+    },
+    'hot_queries': {
+        'columns': ['id', 'window_start', 'intent', 'query', 'count', 'error', 'saved_at'],
+        'table': 'hot_query_snapshots',
+        # 時間窗結束後才寫入，以寫入時間作為水位
+        'watermark': 'saved_at',
+        'kind': 'epoch',
+    },
+    'cached_queries': {
+        'columns': ['intent', 'language', 'query', 'updated_at'],
+        'table': 'answer_cache',
+        'watermark': 'updated_at',
+        'kind': 'epoch',
+    },
+}
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def parse_watermark(value: Optional[str]) -> Optional[datetime]:
+    """解析水位時間（UTC，格式 YYYY-MM-DD HH:MM:SS，也接受 ISO 8601）"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.strip().replace('T', ' ').rstrip('Z'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def format_watermark(value: datetime) -> str:
+    return value.strftime(WATERMARK_FORMAT)
+
+
+def _bound(value: datetime, kind: str):
+    """將水位時間轉成與欄位相同的格式"""
+    if kind == 'epoch':
+        return value.replace(tzinfo=timezone.utc).timestamp()
+    return format_watermark(value)
+
+
+def build_query(name: str, since: Optional[datetime], until: datetime) -> Tuple[str, tuple]:
+    """組出依水位欄位排序的查詢（使用水位欄位索引）"""
+    spec = EXPORTS[name]
+    column = spec['watermark']
+    columns = ', '.join(spec['columns'])
+    if since is None:
+        where = f'{column} <= ? OR {column} IS NULL'
+        params = (_bound(until, spec['kind']),)
+    else:
+        where = f'{column} > ? AND {column} <= ?'
+        params = (_bound(since, spec['kind']), _bound(until, spec['kind']))
+    return f'SELECT {columns} FROM {spec["table"]} WHERE {where} ORDER BY {column}, rowid', params
+
+
+def export_window(since: Optional[datetime] = None) -> Tuple[Optional[datetime], datetime]:
+    """決定這次匯出的範圍，until 即為下一次增量匯出的水位"""
+    until = datetime.utcfromtimestamp(int(time.time()) - WATERMARK_LAG_SECONDS)
+    return since, until
+
+
+def iter_rows(name: str, since: Optional[datetime], until: datetime,
+              db_path: str = DB_PATH, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[tuple]]:
+    """以唯讀連線逐批讀取資料（WAL 模式下不會阻擋寫入）"""
+    sql, params = build_query(name, since, until)
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def stream_export(name: str, fmt: str = 'ndjson', since: Optional[datetime] = None,
+                  until: Optional[datetime] = None, db_path: str = DB_PATH) -> Iterator[str]:
+    """產生匯出內容，每次輸出一批資料"""
+    if until is None:
+        since, until = export_window(since)
+    columns = EXPORTS[name]['columns']
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        for rows in iter_rows(name, since, until, db_path):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue()
+    else:
+        for rows in iter_rows(name, since, until, db_path):
+            yield ''.join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows
+            )
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='串流匯出購物車、價格與查詢統計')
+    parser.add_argument('name', choices=sorted(EXPORTS), help='匯出項目')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson', help='輸出格式')
+    parser.add_argument('--since', help='只匯出此時間（UTC）之後的資料')
+    parser.add_argument('--watermark-file', help='從檔案讀取 since，完成後寫入新的水位')
+    parser.add_argument('--output', help='輸出檔案（預設為標準輸出）')
+    parser.add_argument('--db', default=DB_PATH, help='資料庫路徑')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    since_text = args.since
+    if not since_text and args.watermark_file and os.path.exists(args.watermark_file):
+        with open(args.watermark_file, encoding='utf-8') as f:
+            since_text = f.read().strip()
+    since, until = export_window(parse_watermark(since_text))
+
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for chunk in stream_export(args.name, args.format, since, until, args.db):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+    # 全部寫完才更新水位，中斷時下次會從原水位重新匯出
+    if args.watermark_file:
+        with open(args.watermark_file, 'w', encoding='utf-8') as f:
+            f.write(format_watermark(until))
+    logger.info(f"匯出 {args.name} 完成，水位 {format_watermark(until)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# hot_queries.py - 熱門查詢統計（Space-Saving）與快取預熱
+#
+# 以固定大小的 Space-Saving 結構統計每個時間窗內的 (intent, 查詢) 次數，
+# 時間窗結束時保存前幾名，背景執行緒在快取過期前預先更新最熱門的查詢
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    from . import answer_cache, rate_limit
+except ImportError:
+    import answer_cache
+    import rate_limit
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'bot_data.db'
+
+SKETCH_CAPACITY = int(os.getenv('HOT_QUERY_CAPACITY', '500'))
+WINDOW_SECONDS = float(os.getenv('HOT_QUERY_WINDOW_SECONDS', '3600'))
+SNAPSHOT_TOP_N = 50
+
+WARM_INTERVAL_SECONDS = float(os.getenv('CACHE_WARM_INTERVAL_SECONDS', '300'))
+WARM_TOP_N = int(os.getenv('CACHE_WARM_TOP_N', '20'))
+# 快取年齡超過新鮮期的這個比例就預先更新
+WARM_AT_TTL_FRACTION = 0.8
+
+# 背景預熱在排程器中使用的身分（不扣額度）
+WARMER_USER_ID = '__cache_warmer__'
+
+
+class SpaceSaving:
+    """Space-Saving 熱門項目統計，最多追蹤 capacity 個項目"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.total = 0
+        # key -> [次數, 誤差上限, 顯示用的原始查詢]
+        self._counters: Dict[Tuple[str, str], List] = {}
+
+    def offer(self, key: Tuple[str, str], label: str):
+        self.total += 1
+        counter = self._counters.get(key)
+        if counter is not None:
+            counter[0] += 1
+            counter[2] = label
+            return
+        if len(self._counters) < self.capacity:
+            self._counters[key] = [1, 0, label]
+            return
+        # 取代次數最少的項目，並繼承其次數作為誤差
+        victim = min(self._counters, key=lambda k: self._counters[k][0])
+        count = self._counters.pop(victim)[0]
+        self._counters[key] = [count + 1, count, label]
+
+    def top(self, n: int) -> List[Dict]:
+        ranked = sorted(self._counters.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [{
+            'intent': key[0],
+            'query': counter[2],
+            'count': counter[0],
+            'error': counter[1],
+        } for key, counter in ranked]
+
+
+class HotQueryTracker:
+    """依時間窗統計熱門查詢，保留目前與上一個時間窗"""
+
+    def __init__(self, capacity: int = SKETCH_CAPACITY, window_seconds: float = WINDOW_SECONDS):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._current = SpaceSaving(capacity)
+        self._previous: Optional[SpaceSaving] = None
+        self._pending_snapshots: List[Tuple[float, List[Dict]]] = []
+
+    def _roll_locked(self, now: float):
+        if now - self._window_start < self.window_seconds:
+            return
+        if self._current.total:
+            self._pending_snapshots.append((self._window_start, self._current.top(SNAPSHOT_TOP_N)))
+        self._previous = self._current
+        self._current = SpaceSaving(self.capacity)
+        self._window_start = now
+
+    def record(self, intent: str, query: str):
+        """記錄一次查詢"""
+        if not query:
+            return
+        with self._lock:
+            self._roll_locked(time.time())
+            self._current.offer((intent, answer_cache.normalize_query(query)), query)
+
+    def top(self, n: int = 20) -> Dict:
+        """目前與上一個時間窗的熱門查詢"""
+        with self._lock:
+            self._roll_locked(time.time())
+            return {
+                'window_start': self._window_start,
+                'window_seconds': self.window_seconds,
+                'current': self._current.top(n),
+                'previous': self._previous.top(n) if self._previous else [],
+            }
+
+    def warm_candidates(self, n: int) -> List[Tuple[str, str]]:
+        """合併目前與上一個時間窗，取得最熱門的 (intent, 查詢)"""
+        merged: Dict[Tuple[str, str], List] = {}
+        with self._lock:
+            for sketch in filter(None, (self._previous, self._current)):
+                for item in sketch.top(n):
+                    key = (item['intent'], answer_cache.normalize_query(item['query']))
+                    entry = merged.setdefault(key, [0, item['query']])
+                    entry[0] += item['count']
+        ranked = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(key[0], entry[1]) for key, entry in ranked]
+
+    def take_pending_snapshots(self) -> List[Tuple[float, List[Dict]]]:
+        with self._lock:
+            snapshots, self._pending_snapshots = self._pending_snapshots, []
+        return snapshots
+
+
+tracker = HotQueryTracker()
+# intent -> (回答產生函式, 快取語言)
+_warmers: Dict[str, Tuple[Callable[[str], str], str]] = {}
+_warmer_thread = None
+
+
+def record(intent: str, query: str):
+    """記錄一次查詢（供意圖處理呼叫）"""
+    tracker.record(intent, query)
+
+
+def register_warmer(intent: str, generate: Callable[[str], str], language: str = 'zh-tw'):
+    """登記某個意圖的回答產生函式，供預熱使用"""
+    _warmers[intent] = (generate, language)
+
+
+def save_snapshots(db_path: str = DB_PATH) -> int:
+    """將已結束時間窗的熱門查詢寫入資料庫"""
+    snapshots = tracker.take_pending_snapshots()
+    saved_at = time.time()
+    rows = [
+        (window_start, item['intent'], item['query'], item['count'], item['error'], saved_at)
+        for window_start, items in snapshots for item in items
+    ]
+    if not rows:
+        return 0
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.executemany(
+            'INSERT INTO hot_query_snapshots (window_start, intent, query, count, error, saved_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"保存熱門查詢失敗: {e}")
+        return 0
+    return len(rows)
+
+
+def warm_cache(top_n: int = WARM_TOP_N) -> int:
+    """為即將過期或尚未快取的熱門查詢預先產生回答，回傳更新數量"""
+    warmed = 0
+    for intent, query in tracker.warm_candidates(top_n):
+        warmer = _warmers.get(intent)
+        if warmer is None:
+            continue
+
+        generate, language = warmer
+        entry = answer_cache.get_entry(intent, query, language)
+        ttl = answer_cache.FRESH_TTL.get(intent, answer_cache.DEFAULT_FRESH_TTL)
+        if entry and time.time() - entry[1] < ttl * WARM_AT_TTL_FRACTION:
+            continue
+        # 確定要更新才檢查上游，避免斷路器的試探名額用在不需要更新的查詢
+        if not answer_cache.upstream_available():
+            break
+
+        try:
+            with rate_limit.acting_as(WARMER_USER_ID, charge=False):
+                answer_cache.regenerate(intent, query, lambda: generate(query), language)
+            warmed += 1
+        except rate_limit.LoadShed:
+            # 用戶請求優先，這一輪不再預熱
+            break
+        except Exception as e:
+            logger.warning(f"預熱快取失敗 ({intent}: {query}): {e}")
+    return warmed
+
+
+def start_warmer(interval_seconds: float = WARM_INTERVAL_SECONDS):
+    """啟動背景預熱執行緒（每個行程只會啟動一次）"""
+    global _warmer_thread
+    if interval_seconds <= 0 or (_warmer_thread and _warmer_thread.is_alive()):
+        return
+
+    def worker():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                save_snapshots()
+                warmed = warm_cache()
+                if warmed:
+                    logger.info(f"已預熱 {warmed} 個熱門查詢")
+            except Exception as e:
+                logger.error(f"快取預熱失敗: {e}")
+
+    _warmer_thread = threading.Thread(target=worker, name='cache-warmer', daemon=True)
+    _warmer_thread.start()
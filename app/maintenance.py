@@ -0,0 +1,274 @@
+# maintenance.py - 資料庫保存期限、壓縮與報表
+#
+# 用法：python -m app.maintenance [--report-only] [--vacuum] [--archive bot_archive.db]
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    from . import answer_cache
+except ImportError:
+    import answer_cache
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'bot_data.db'
+
+# 每批刪除的筆數與批次間隔，避免長時間佔用寫入鎖
+BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', '500'))
+BATCH_PAUSE_SECONDS = 0.05
+
+# 每次維護最多釋放的頁數
+INCREMENTAL_VACUUM_PAGES = 2000
+
+CART_RETENTION_DAYS = int(os.getenv('CART_RETENTION_DAYS', '90'))
+ANSWER_CACHE_RETENTION_DAYS = int(os.getenv('ANSWER_CACHE_RETENTION_DAYS', '30'))
+HOT_QUERY_RETENTION_DAYS = int(os.getenv('HOT_QUERY_RETENTION_DAYS', '90'))
+
+# 保存規則：where 以 ? 接收 cutoff(days) 的結果
+RETENTION_RULES = [
+    {
+        # 最後一次異動（加入或變更數量）超過期限的購物車視為放棄
+        'table': 'cart',
+        'where': (
+            "user_id IN (SELECT user_id FROM cart GROUP BY user_id "
+            "HAVING MAX(updated_at) < datetime('now', ?))"
+        ),
+        'cutoff': lambda days: f'-{days} days',
+        'days': CART_RETENTION_DAYS,
+        'bump_cart_versions': True,
+    },
+    {
+        'table': 'answer_cache',
+        'where': 'updated_at < ?',
+        'cutoff': lambda days: time.time() - days * 86400,
+        'days': ANSWER_CACHE_RETENTION_DAYS,
+    },
+    {
+        'table': 'hot_query_snapshots',
+        'where': 'window_start < ?',
+        'cutoff': lambda days: time.time() - days * 86400,
+        'days': HOT_QUERY_RETENTION_DAYS,
+    },
+]
+
+# 背景維護間隔（秒），0 表示停用
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv('MAINTENANCE_INTERVAL_SECONDS', '21600'))
+
+_background_thread = None
+
+
+def _table_exists(cursor, table: str) -> bool:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+
+def migrate_cart_product_keys(conn) -> int:
+    """
+    以目前的 answer_cache.normalize_query 重新計算購物車的正規化名稱（新欄位回填，或正規化規則改變），
+    並將同一用戶的重複商品合併到最早的一筆（數量相加、異動時間取最新），回傳合併掉的筆數（不提交交易）
+    需要重新計算時會先移除 (user_id, product_key) 唯一索引，由呼叫端重新建立
+    """
+    conn.create_function('normalize_product', 1, answer_cache.normalize_query)
+    cursor = conn.cursor()
+    stale = 'product_key IS NULL OR product_key <> normalize_product(product)'
+    cursor.execute(f'SELECT 1 FROM cart WHERE {stale} LIMIT 1')
+    if cursor.fetchone() is None:
+        return 0
+
+    cursor.execute('DROP INDEX IF EXISTS idx_cart_user_product_key')
+    cursor.execute(f'UPDATE cart SET product_key = normalize_product(product) WHERE {stale}')
+    cursor.execute('''
+        CREATE TEMP TABLE cart_duplicates AS
+        SELECT user_id, product_key, MIN(id) AS keep_id, SUM(quantity) AS quantity,
+               MAX(COALESCE(updated_at, added_time)) AS updated_at
+        FROM cart GROUP BY user_id, product_key HAVING COUNT(*) > 1
+    ''')
+    cursor.execute('''
+        UPDATE cart SET
+            quantity = (SELECT quantity FROM cart_duplicates WHERE keep_id = cart.id),
+            updated_at = (SELECT updated_at FROM cart_duplicates WHERE keep_id = cart.id)
+        WHERE id IN (SELECT keep_id FROM cart_duplicates)
+    ''')
+    cursor.execute('''
+        DELETE FROM cart WHERE id IN (
+            SELECT c.id FROM cart c JOIN cart_duplicates d
+            ON c.user_id = d.user_id AND c.product_key = d.product_key AND c.id <> d.keep_id
+        )
+    ''')
+    merged = cursor.rowcount
+    cursor.execute('''
+        UPDATE cart_versions SET version = version + 1
+        WHERE user_id IN (SELECT user_id FROM cart_duplicates)
+    ''')
+    cursor.execute('DROP TABLE cart_duplicates')
+    logger.info(f"購物車正規化名稱更新完成，合併重複商品 {merged} 筆")
+    return merged
+
+
+def purge_expired_rows(conn, rule: Dict, archive: bool = False) -> int:
+    """依保存規則分批刪除（或搬到封存資料庫）過期資料，回傳處理筆數"""
+    table = rule['table']
+    cursor = conn.cursor()
+    if not _table_exists(cursor, table):
+        return 0
+
+    if archive:
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0')
+        # 封存表建立後主資料表新增的欄位，補到封存表
+        cursor.execute(f'PRAGMA archive.table_info({table})')
+        archived_columns = {row[1] for row in cursor.fetchall()}
+        cursor.execute(f'PRAGMA main.table_info({table})')
+        main_columns = cursor.fetchall()
+        for row in main_columns:
+            if row[1] not in archived_columns:
+                cursor.execute(f'ALTER TABLE archive.{table} ADD COLUMN {row[1]} {row[2]}')
+        columns = ', '.join(row[1] for row in main_columns)
+        conn.commit()
+
+    cutoff = rule['cutoff'](rule['days'])
+    total = 0
+    while True:
+        cursor.execute(f"SELECT rowid FROM main.{table} WHERE {rule['where']} LIMIT ?", (cutoff, BATCH_SIZE))
+        rowids = [row[0] for row in cursor.fetchall()]
+        if not rowids:
+            break
+
+        placeholders = ','.join('?' * len(rowids))
+        if archive:
+            cursor.execute(
+                f'INSERT INTO archive.{table} ({columns}) SELECT {columns} FROM main.{table} '
+                f'WHERE rowid IN ({placeholders})',
+                rowids
+            )
+        if rule.get('bump_cart_versions'):
+            cursor.execute(
+                f'UPDATE cart_versions SET version = version + 1 WHERE user_id IN '
+                f'(SELECT DISTINCT user_id FROM main.{table} WHERE rowid IN ({placeholders}))',
+                rowids
+            )
+        cursor.execute(f'DELETE FROM main.{table} WHERE rowid IN ({placeholders})', rowids)
+        conn.commit()
+
+        total += len(rowids)
+        if len(rowids) < BATCH_SIZE:
+            break
+        time.sleep(BATCH_PAUSE_SECONDS)
+
+    if total:
+        logger.info(f"{table} 清除過期資料 {total} 筆")
+    return total
+
+
+def compact(conn, full_vacuum: bool = False):
+    """釋放空間、更新統計資訊並截斷 WAL"""
+    cursor = conn.cursor()
+    if full_vacuum:
+        # 完整 VACUUM 會鎖住資料庫，只在 CLI 明確要求時執行；同時套用 incremental auto_vacuum
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+    else:
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] == 2:
+            cursor.execute(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})')
+            cursor.fetchall()
+        else:
+            logger.info("資料庫未啟用 incremental auto_vacuum，請執行一次 --vacuum")
+    cursor.execute('PRAGMA optimize')
+    cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    cursor.fetchall()
+
+
+def database_report(conn) -> Dict:
+    """回報各資料表筆數與大小"""
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA page_size')
+    page_size = cursor.fetchone()[0]
+    cursor.execute('PRAGMA page_count')
+    page_count = cursor.fetchone()[0]
+    cursor.execute('PRAGMA freelist_count')
+    freelist_count = cursor.fetchone()[0]
+
+    # dbstat 需要 SQLite 編譯時啟用，沒有時只回報筆數
+    sizes = {}
+    try:
+        cursor.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')
+        sizes = dict(cursor.fetchall())
+    except sqlite3.Error:
+        pass
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    tables = {}
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'SELECT COUNT(*) FROM "{name}"')
+        tables[name] = {'rows': cursor.fetchone()[0], 'bytes': sizes.get(name)}
+
+    return {
+        'file_bytes': page_size * page_count,
+        'free_bytes': page_size * freelist_count,
+        'tables': tables,
+    }
+
+
+def run_maintenance(db_path: str = DB_PATH, archive_path: Optional[str] = None,
+                    full_vacuum: bool = False, report_only: bool = False) -> Dict:
+    """執行一次完整維護並回傳報表"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        purged = {}
+        if not report_only:
+            if archive_path:
+                conn.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+            for rule in RETENTION_RULES:
+                purged[rule['table']] = purge_expired_rows(conn, rule, archive=bool(archive_path))
+            if archive_path:
+                conn.execute('DETACH DATABASE archive')
+            compact(conn, full_vacuum)
+
+        report = database_report(conn)
+        report['purged'] = purged
+        return report
+    finally:
+        conn.close()
+
+
+def start_background_maintenance(interval_seconds: float = MAINTENANCE_INTERVAL_SECONDS,
+                                 db_path: str = DB_PATH):
+    """啟動背景維護執行緒（每個行程只會啟動一次）"""
+    global _background_thread
+    if interval_seconds <= 0 or (_background_thread and _background_thread.is_alive()):
+        return
+
+    def worker():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                report = run_maintenance(db_path)
+                logger.info(f"資料庫維護完成: {json.dumps(report, ensure_ascii=False)}")
+            except Exception as e:
+                logger.error(f"資料庫維護失敗: {e}")
+
+    _background_thread = threading.Thread(target=worker, name='db-maintenance', daemon=True)
+    _background_thread.start()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='bot_data.db 保存期限與壓縮維護')
+    parser.add_argument('--db', default=DB_PATH, help='資料庫路徑')
+    parser.add_argument('--archive', help='過期資料搬到此封存資料庫，而不是直接刪除')
+    parser.add_argument('--vacuum', action='store_true', help='執行完整 VACUUM（會短暫鎖住資料庫）')
+    parser.add_argument('--report-only', action='store_true', help='只回報資料表大小與筆數')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    report = run_maintenance(args.db, args.archive, args.vacuum, args.report_only)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
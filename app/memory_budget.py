@@ -0,0 +1,213 @@
+# memory_budget.py - 行程內資料的記憶體預算與 tracemalloc 診斷
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MEMORY_CHECK_INTERVAL_SECONDS = float(os.getenv('MEMORY_CHECK_INTERVAL_SECONDS', '60'))
+
+# 估算大型容器時平均間隔抽樣這麼多個元素再依比例推估
+SIZE_SAMPLE_ITEMS = 200
+
+# 超過預算時淘汰到預算的這個比例，避免每次檢查都在邊緣反覆淘汰
+EVICT_TARGET_RATIO = 0.8
+
+_stores: Dict[str, Dict] = {}
+_stores_lock = threading.Lock()
+_previous_snapshot = None
+_watchdog_thread = None
+_MISSING = object()
+
+
+def approximate_size(obj, sample_items: int = SIZE_SAMPLE_ITEMS) -> int:
+    """
+    以抽樣方式遞迴估算物件佔用的位元組數
+    大型容器以固定間隔抽樣約 sample_items 個元素再依比例推估（只取開頭會偏向最早建立、
+    通常也最大的項目）；抽樣元素內部的容器完整量測、不再推估，避免重複放大
+    """
+    seen = set()
+
+    def sizeof(value, extrapolate: bool) -> int:
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        size = sys.getsizeof(value)
+
+        if isinstance(value, dict):
+            children = value.items()
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            children = value
+        elif hasattr(value, '__dict__'):
+            return size + sizeof(vars(value), extrapolate)
+        else:
+            return size
+
+        count = len(value)
+        if not count:
+            return size
+        sampled = extrapolate and count > sample_items
+        if sampled:
+            children = itertools.islice(children, 0, None, count // sample_items)
+        # 抽樣時元素內部不再推估；完整量測的小容器（例如物件屬性）則沿用外層設定
+        nested = extrapolate and not sampled
+        measured = 0
+        taken = 0
+        for child in children:
+            if isinstance(value, dict):
+                measured += sizeof(child[0], nested) + sizeof(child[1], nested)
+            else:
+                measured += sizeof(child, nested)
+            taken += 1
+        if not sampled:
+            return size + measured
+        return size + measured * count // taken
+
+    return sizeof(obj, True)
+
+
+def register_store(name: str, get_container: Callable[[], object],
+                   evict: Callable[[float], int], default_budget_mb: float,
+                   measure: Optional[Callable[[], int]] = None):
+    """
+    登記一個行程內資料儲存區
+    evict(fraction) 應移除約 fraction 比例的項目並回傳移除數量；
+    內部有共用物件的結構可提供 measure() 回傳位元組數，否則以 approximate_size 估算；
+    預算可用環境變數 MEMORY_BUDGET_<NAME>_MB 覆寫
+    """
+    budget_mb = float(os.getenv(f'MEMORY_BUDGET_{name.upper()}_MB', default_budget_mb))
+    with _stores_lock:
+        _stores[name] = {
+            'get_container': get_container,
+            'evict': evict,
+            'measure': measure,
+            'budget_bytes': int(budget_mb * 1024 * 1024),
+        }
+
+
+def evict_oldest(container: Dict, fraction: float) -> int:
+    """依插入順序移除 dict 中最舊的一部分項目"""
+    count = int(len(container) * fraction) + 1
+    removed = 0
+    for key in list(itertools.islice(container.keys(), count)):
+        # 其他執行緒可能同時移除同一個鍵
+        if container.pop(key, _MISSING) is not _MISSING:
+            removed += 1
+    return removed
+
+
+def check_budgets(evict: bool = True) -> Dict[str, Dict]:
+    """量測各儲存區，超過預算時主動淘汰（evict=False 時只量測），回傳量測結果"""
+    with _stores_lock:
+        stores = dict(_stores)
+
+    usage = {}
+    for name, store in stores.items():
+        container = store['get_container']()
+        try:
+            size = store['measure']() if store['measure'] else approximate_size(container)
+        except RuntimeError:
+            # 量測期間被其他執行緒修改，下一輪再量
+            continue
+
+        evicted = 0
+        if evict and size > store['budget_bytes']:
+            fraction = 1 - store['budget_bytes'] * EVICT_TARGET_RATIO / size
+            try:
+                evicted = store['evict'](fraction)
+            except Exception as e:
+                logger.error(f"{name} 淘汰資料失敗: {e}")
+            logger.warning(f"{name} 使用約 {size} bytes，超過預算 {store['budget_bytes']}，已淘汰 {evicted} 筆")
+
+        usage[name] = {
+            'bytes': size,
+            'budget_bytes': store['budget_bytes'],
+            'over_budget': size > store['budget_bytes'],
+            'entries': len(container) if hasattr(container, '__len__') else None,
+            'evicted': evicted,
+        }
+
+    return usage
+
+
+def process_rss_bytes() -> Optional[int]:
+    """目前行程的常駐記憶體（僅 Linux 可用）"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def diagnostics() -> Dict:
+    """記憶體診斷資訊（只量測，淘汰交給背景檢查）"""
+    return {
+        'rss_bytes': process_rss_bytes(),
+        'stores': check_budgets(evict=False),
+        'tracemalloc': tracemalloc.is_tracing(),
+    }
+
+
+def _take_snapshot():
+    """取得排除 tracemalloc 與匯入機制本身的快照"""
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+
+def start_tracing(frames: int = 10):
+    """開始 tracemalloc 追蹤並記錄基準快照"""
+    global _previous_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _previous_snapshot = _take_snapshot()
+
+
+def stop_tracing():
+    """停止 tracemalloc 追蹤"""
+    global _previous_snapshot
+    _previous_snapshot = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def snapshot_diff(limit: int = 20) -> List[str]:
+    """與上一次快照比較，回傳成長最多的配置位置"""
+    global _previous_snapshot
+    if not tracemalloc.is_tracing():
+        start_tracing()
+        return []
+
+    snapshot = _take_snapshot()
+    previous = _previous_snapshot
+    _previous_snapshot = snapshot
+    if previous is None:
+        return []
+    return [str(stat) for stat in snapshot.compare_to(previous, 'lineno')[:limit]]
+
+
+def start_watchdog(interval_seconds: float = MEMORY_CHECK_INTERVAL_SECONDS):
+    """啟動背景記憶體檢查執行緒（每個行程只會啟動一次）"""
+    global _watchdog_thread
+    if interval_seconds <= 0 or (_watchdog_thread and _watchdog_thread.is_alive()):
+        return
+
+    def worker():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                check_budgets()
+            except Exception as e:
+                logger.error(f"記憶體預算檢查失敗: {e}")
+
+    _watchdog_thread = threading.Thread(target=worker, name='memory-watchdog', daemon=True)
+    _watchdog_thread.start()
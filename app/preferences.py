@@ -0,0 +1,254 @@
+# preferences.py - 用戶偏好（語言、預算、品牌）的記憶體快取與批次寫回
+#
+# 啟動時一次載入 user_preferences，之後每則訊息只讀寫記憶體，
+# 異動由背景執行緒定期批次寫回 SQLite
+import atexit
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    from . import memory_budget
+except ImportError:
+    import memory_budget
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'bot_data.db'
+
+PREFERENCES_FLUSH_SECONDS = float(os.getenv('PREFERENCES_FLUSH_SECONDS', '5'))
+
+# 偵測語言時至少需要的文字長度，太短的訊息不學習語言
+MIN_LANGUAGE_TEXT_LENGTH = 6
+
+# 已知語言的用戶每隔幾則訊息重新偵測一次，讓誤判的語言偏好有機會修正
+LANGUAGE_RECHECK_MESSAGES = int(os.getenv('LANGUAGE_RECHECK_MESSAGES', '20'))
+
+# 依字元種類判斷語言：假名為日文、諺文為韓文、漢字為繁體中文
+SCRIPT_LANGUAGES = [
+    (re.compile(r'[\u3040-\u30ff]'), 'ja'),
+    (re.compile(r'[\uac00-\ud7af\u1100-\u11ff\u3130-\u318f]'), 'ko'),
+    (re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]'), 'zh-tw'),
+]
+
+MAX_PREFERRED_BRANDS = 5
+
+# 品牌關鍵字與統一名稱
+BRAND_KEYWORDS = {
+    'apple': 'Apple', 'iphone': 'Apple', 'ipad': 'Apple', 'macbook': 'Apple', '蘋果': 'Apple',
+    'samsung': 'Samsung', '三星': 'Samsung', 'galaxy': 'Samsung',
+    'asus': 'ASUS', '華碩': 'ASUS',
+    'acer': 'Acer', '宏碁': 'Acer',
+    'google': 'Google', 'pixel': 'Google',
+    'sony': 'Sony', '索尼': 'Sony',
+    'xiaomi': 'Xiaomi', '小米': 'Xiaomi',
+    'oppo': 'OPPO', 'vivo': 'vivo',
+    'lenovo': 'Lenovo', '聯想': 'Lenovo',
+    'msi': 'MSI', '微星': 'MSI',
+    'dell': 'Dell', 'hp': 'HP',
+}
+
+# 預算金額：需有單位，避免把型號數字誤認為預算
+BUDGET_PATTERNS = [
+    (re.compile(r'(\d+(?:\.\d+)?)\s*萬'), 10000),
+    (re.compile(r'(\d+(?:\.\d+)?)\s*千'), 1000),
+    (re.compile(r'(?:NT\$|\$)\s*(\d[\d,]*)'), 1),
+    (re.compile(r'(\d[\d,]{2,})\s*(?:元|塊)'), 1),
+]
+
+_cache: Dict[str, Dict] = {}
+_dirty = set()
+_lock = threading.Lock()
+_flush_thread = None
+
+
+def load_all(db_path: str = DB_PATH):
+    """一次載入所有用戶偏好到記憶體"""
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, preferred_language, budget_range, preferred_brands FROM user_preferences')
+        rows = cursor.fetchall()
+        conn.close()
+    except Exception as e:
+        logger.error(f"載入用戶偏好失敗: {e}")
+        return
+
+    with _lock:
+        for user_id, language, budget, brands in rows:
+            if user_id in _dirty:
+                continue
+            _cache[user_id] = {
+                'preferred_language': language,
+                'budget_range': budget,
+                'preferred_brands': [brand for brand in (brands or '').split(',') if brand],
+            }
+    logger.info(f"已載入 {len(rows)} 位用戶的偏好")
+
+
+def get(user_id: str) -> Optional[Dict]:
+    """取得用戶偏好（只讀記憶體）"""
+    return _cache.get(user_id)
+
+
+def get_language(user_id: str) -> Optional[str]:
+    """取得已知的偏好語言，未知時回傳 None"""
+    preference = _cache.get(user_id)
+    return preference['preferred_language'] if preference else None
+
+
+def script_language(text: str) -> Optional[str]:
+    """依文字中的 CJK 字元判斷語言，沒有 CJK 字元時回傳 None"""
+    for pattern, language in SCRIPT_LANGUAGES:
+        if pattern.search(text):
+            return language
+    return None
+
+
+def language_check_due(user_id: str, text: str) -> bool:
+    """判斷這則訊息是否需要偵測語言：尚無語言偏好、字元種類與偏好不符，或已到定期重新偵測的時候"""
+    with _lock:
+        preference = _cache.get(user_id)
+        if not preference or not preference['preferred_language']:
+            return True
+        script = script_language(text)
+        count = preference.get('messages_since_language_check', 0) + 1
+        if (script and script != preference['preferred_language']) or count >= LANGUAGE_RECHECK_MESSAGES:
+            preference['messages_since_language_check'] = 0
+            return True
+        preference['messages_since_language_check'] = count
+        return False
+
+
+def extract_budget(text: str) -> Optional[str]:
+    """從文字中擷取預算金額（元）"""
+    for pattern, unit in BUDGET_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            amount = float(match.group(1).replace(',', '')) * unit
+            if amount >= 100:
+                return str(int(amount))
+    return None
+
+
+def extract_brands(text: str) -> List[str]:
+    """從文字中擷取提到的品牌"""
+    text_lower = text.lower()
+    brands = []
+    for keyword, brand in BRAND_KEYWORDS.items():
+        if brand not in brands and re.search(rf'(?<![a-z]){re.escape(keyword)}(?![a-z])', text_lower):
+            brands.append(brand)
+    return brands
+
+
+def learn(user_id: str, text: str, detected_language: Optional[str] = None):
+    """從用戶訊息學習偏好，只更新記憶體並標記待寫回"""
+    budget = extract_budget(text)
+    brands = extract_brands(text)
+    if detected_language:
+        # 含中日韓字元的訊息以字元種類為準，避免「iPhone 15 價格」這類混合文字被記成英文
+        detected_language = script_language(text) or detected_language
+    learn_language = detected_language and len(text.strip()) >= MIN_LANGUAGE_TEXT_LENGTH
+    if not (budget or brands or learn_language):
+        return
+
+    with _lock:
+        preference = _cache.get(user_id)
+        if preference is None:
+            preference = {'preferred_language': None, 'budget_range': None, 'preferred_brands': []}
+            _cache[user_id] = preference
+
+        changed = False
+        if learn_language:
+            # 連續兩次偵測到相同語言才記錄，避免單次誤判後就不再偵測
+            if preference.get('candidate_language') == detected_language:
+                if preference['preferred_language'] != detected_language:
+                    preference['preferred_language'] = detected_language
+                    changed = True
+            preference['candidate_language'] = detected_language
+        if budget and preference['budget_range'] != budget:
+            preference['budget_range'] = budget
+            changed = True
+        if brands:
+            # 最近提到的品牌排在前面
+            merged = brands + [brand for brand in preference['preferred_brands'] if brand not in brands]
+            merged = merged[:MAX_PREFERRED_BRANDS]
+            if merged != preference['preferred_brands']:
+                preference['preferred_brands'] = merged
+                changed = True
+        if changed:
+            _dirty.add(user_id)
+
+
+def flush(db_path: str = DB_PATH) -> int:
+    """將異動的偏好批次寫回資料庫，回傳寫入筆數"""
+    with _lock:
+        if not _dirty:
+            return 0
+        rows = [
+            (
+                user_id,
+                _cache[user_id]['preferred_language'],
+                _cache[user_id]['budget_range'],
+                ','.join(_cache[user_id]['preferred_brands']) or None,
+            )
+            for user_id in _dirty if user_id in _cache
+        ]
+        pending = set(_dirty)
+        _dirty.clear()
+
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        # 記憶體中沒有的欄位（例如被淘汰後重新學習）保留資料庫原值
+        cursor.executemany('''
+            INSERT INTO user_preferences (user_id, preferred_language, budget_range, preferred_brands)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                preferred_language = COALESCE(excluded.preferred_language, preferred_language),
+                budget_range = COALESCE(excluded.budget_range, budget_range),
+                preferred_brands = COALESCE(excluded.preferred_brands, preferred_brands)
+        ''', rows)
+        conn.commit()
+        conn.close()
+        return len(rows)
+    except Exception as e:
+        logger.error(f"寫回用戶偏好失敗: {e}")
+        with _lock:
+            _dirty.update(pending)
+        return 0
+
+
+def evict(fraction: float) -> int:
+    """記憶體超過預算時，先寫回再移除最舊的偏好"""
+    flush()
+    with _lock:
+        clean = [user_id for user_id in _cache if user_id not in _dirty]
+        evicted = clean[:int(len(clean) * fraction) + 1]
+        for user_id in evicted:
+            del _cache[user_id]
+    return len(evicted)
+
+
+def start_write_behind(interval_seconds: float = PREFERENCES_FLUSH_SECONDS):
+    """載入偏好並啟動背景寫回執行緒（每個行程只會啟動一次）"""
+    global _flush_thread
+    if _flush_thread and _flush_thread.is_alive():
+        return
+    load_all()
+
+    def worker():
+        while True:
+            time.sleep(interval_seconds)
+            flush()
+
+    _flush_thread = threading.Thread(target=worker, name='preferences-flush', daemon=True)
+    _flush_thread.start()
+    atexit.register(flush)
+
+
+memory_budget.register_store('preferences', lambda: _cache, evict, 16)
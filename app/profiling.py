@@ -0,0 +1,153 @@
+# profiling.py - 線上請求抽樣效能分析（cProfile）
+#
+# 以環境變數 PROFILE_SAMPLE_RATE 或管理 API 啟用，依意圖彙整 pstats 檔，
+# 收集到指定樣本數後自動停用；停用時只多一次布林判斷
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP_FILES = int(os.getenv('PROFILE_KEEP_FILES', '50'))
+PROFILE_FLUSH_EVERY = int(os.getenv('PROFILE_FLUSH_EVERY', '20'))
+
+enabled = False
+_sample_rate = 0.0
+_remaining = 0
+_collected = 0
+_pending: Dict[str, int] = {}
+_stats: Dict[str, pstats.Stats] = {}
+_state_lock = threading.Lock()
+# cProfile 同時只能有一個在執行，忙碌時直接略過這次抽樣
+_profiler_lock = threading.Lock()
+_local = threading.local()
+
+
+def start(sample_rate: float, max_samples: int):
+    """開始抽樣，收集 max_samples 筆後自動停止"""
+    global enabled, _sample_rate, _remaining, _collected
+    with _state_lock:
+        _sample_rate = min(max(sample_rate, 0.0), 1.0)
+        _remaining = max_samples
+        _collected = 0
+        enabled = _sample_rate > 0 and _remaining > 0
+    logger.info(f"效能分析已啟用：抽樣率 {_sample_rate}，樣本數 {max_samples}")
+
+
+def stop():
+    """停止抽樣並寫出尚未儲存的結果"""
+    global enabled
+    with _state_lock:
+        enabled = False
+        _flush_locked()
+
+
+def status() -> Dict:
+    """目前的抽樣狀態"""
+    with _state_lock:
+        return {
+            'enabled': enabled,
+            'sample_rate': _sample_rate,
+            'remaining': _remaining,
+            'collected': _collected,
+            'pending': dict(_pending),
+            'directory': os.path.abspath(PROFILE_DIR),
+        }
+
+
+def tag(label: str):
+    """標記目前請求的意圖，作為彙整分類"""
+    if enabled:
+        _local.label = label
+
+
+@contextlib.contextmanager
+def _profile_request():
+    profiler = cProfile.Profile()
+    _local.label = 'unknown'
+    try:
+        profiler.enable()
+        yield
+    finally:
+        profiler.disable()
+        _profiler_lock.release()
+        _record(_local.label, profiler)
+
+
+_disabled = contextlib.nullcontext()
+
+
+def maybe_profile():
+    """依抽樣率決定是否分析這次請求，回傳 context manager"""
+    if not enabled or random.random() >= _sample_rate:
+        return _disabled
+    if not _profiler_lock.acquire(blocking=False):
+        return _disabled
+    return _profile_request()
+
+
+def _record(label: str, profiler: cProfile.Profile):
+    global enabled, _remaining, _collected
+    with _state_lock:
+        if _remaining <= 0:
+            return
+        if label in _stats:
+            _stats[label].add(profiler)
+        else:
+            _stats[label] = pstats.Stats(profiler)
+        _pending[label] = _pending.get(label, 0) + 1
+        _remaining -= 1
+        _collected += 1
+
+        if _pending[label] >= PROFILE_FLUSH_EVERY:
+            _flush_locked(label)
+        if _remaining <= 0:
+            enabled = False
+            _flush_locked()
+            logger.info(f"效能分析已收集 {_collected} 筆樣本，自動停用")
+
+
+def _flush_locked(label: Optional[str] = None):
+    """寫出 pstats 檔並輪替舊檔（呼叫端需持有 _state_lock）"""
+    labels = [label] if label else list(_stats.keys())
+    if not labels:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    for name in labels:
+        stats = _stats.pop(name, None)
+        count = _pending.pop(name, 0)
+        if stats is None:
+            continue
+        path = os.path.join(PROFILE_DIR, f"{name}-{timestamp}-{_collected}-n{count}.pstats")
+        try:
+            stats.dump_stats(path)
+        except Exception as e:
+            logger.error(f"寫入效能分析檔失敗: {e}")
+    _rotate_files()
+
+
+def _rotate_files():
+    """只保留最新的 PROFILE_KEEP_FILES 個檔案"""
+    files = [
+        os.path.join(PROFILE_DIR, name)
+        for name in os.listdir(PROFILE_DIR) if name.endswith('.pstats')
+    ]
+    files.sort(key=os.path.getmtime)
+    for path in files[:-PROFILE_KEEP_FILES] if PROFILE_KEEP_FILES > 0 else files:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# 以環境變數在啟動時啟用
+if float(os.getenv('PROFILE_SAMPLE_RATE', '0')) > 0:
+    start(float(os.getenv('PROFILE_SAMPLE_RATE')), int(os.getenv('PROFILE_MAX_SAMPLES', '200')))
@@ -0,0 +1,189 @@
+# rate_limit.py - 每位用戶的流量限制與上游公平排程
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+try:
+    from . import memory_budget
+except ImportError:
+    import memory_budget
+
+logger = logging.getLogger(__name__)
+
+# 指令成本：購物車、說明等本地指令很便宜，需要呼叫 LLM 的查詢較昂貴
+COST_CHEAP = 1
+COST_EXPENSIVE = 5
+
+BUCKET_CAPACITY = float(os.getenv('RATE_LIMIT_CAPACITY', '20'))
+BUCKET_REFILL_PER_SECOND = float(os.getenv('RATE_LIMIT_REFILL_PER_SECOND', '0.2'))
+
+# 同時呼叫上游的上限，以及回覆期限（LINE reply token 有時效）
+UPSTREAM_CONCURRENCY = int(os.getenv('UPSTREAM_CONCURRENCY', '4'))
+REPLY_DEADLINE_SECONDS = float(os.getenv('REPLY_DEADLINE_SECONDS', '25'))
+
+
+# 沒有用戶身分的上游呼叫（背景更新快取）在排程器中使用的身分
+BACKGROUND_USER_ID = '__background__'
+
+
+class LoadShed(Exception):
+    """排隊時間將超過回覆期限，拒絕這次請求"""
+
+
+class RateLimited(Exception):
+    """用戶額度不足以再呼叫上游"""
+
+
+# 流量控制拒絕的請求：呼叫端應回覆忙碌訊息，而不是當成上游失敗
+REJECTIONS = (RateLimited, LoadShed)
+
+
+class TokenBucketLimiter:
+    """以 user_id 為單位的 token bucket（行程內共用）"""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def _refilled(self, user_id: str, now: float) -> float:
+        tokens, updated_at = self._buckets.get(user_id, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated_at) * self.refill_per_second)
+
+    def try_consume(self, user_id: str, cost: float) -> bool:
+        """嘗試扣除額度，不足時回傳 False"""
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._refilled(user_id, now)
+            if tokens < cost:
+                self._buckets[user_id] = (tokens, now)
+                return False
+            self._buckets[user_id] = (tokens - cost, now)
+            return True
+
+    def prune(self):
+        """移除已補滿的 bucket，避免閒置用戶佔用記憶體"""
+        now = time.monotonic()
+        with self._lock:
+            for user_id in list(self._buckets.keys()):
+                if self._refilled(user_id, now) >= self.capacity:
+                    del self._buckets[user_id]
+
+    def evict(self, fraction: float) -> int:
+        """記憶體超過預算時移除最舊的 bucket（被移除的用戶視為額度已補滿）"""
+        with self._lock:
+            return memory_budget.evict_oldest(self._buckets, fraction)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class FairScheduler:
+    """限制上游同時請求數，等待中的請求依用戶輪流放行"""
+
+    def __init__(self, max_concurrent: int, deadline: float):
+        self.max_concurrent = max(1, max_concurrent)
+        self.deadline = deadline
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._queues: 'OrderedDict[str, deque]' = OrderedDict()
+        self._avg_service_time = 5.0
+
+    def _next_ticket(self):
+        if not self._queues:
+            return None
+        return self._queues[next(iter(self._queues))][0]
+
+    def _remove_ticket(self, user_id: str, ticket):
+        queue = self._queues.get(user_id)
+        if queue is None:
+            return
+        queue.remove(ticket)
+        if queue:
+            # 放行後移到隊尾，讓其他用戶先輪到
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+        self._waiting -= 1
+
+    def run(self, user_id: str, func: Callable[[], str]) -> str:
+        """取得上游名額後執行 func，排不到名額時拋出 LoadShed"""
+        start = time.monotonic()
+        ticket = object()
+        with self._cond:
+            if self._active >= self.max_concurrent or self._queues:
+                wait = (self._waiting + 1) * self._avg_service_time / self.max_concurrent
+                if wait > self.deadline:
+                    raise LoadShed(f"預估等待 {wait:.1f} 秒超過回覆期限")
+                self._queues.setdefault(user_id, deque()).append(ticket)
+                self._waiting += 1
+                while not (self._active < self.max_concurrent and self._next_ticket() is ticket):
+                    remaining = self.deadline - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self._remove_ticket(user_id, ticket)
+                        self._cond.notify_all()
+                        raise LoadShed("排隊時間超過回覆期限")
+                    self._cond.wait(remaining)
+                self._remove_ticket(user_id, ticket)
+                # 隊首換人了：先前醒來時還輪不到的等待者要重新檢查，否則空出的名額會閒置
+                self._cond.notify_all()
+            self._active += 1
+
+        started = time.monotonic()
+        try:
+            return func()
+        finally:
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * elapsed
+                self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        """目前排程狀態"""
+        with self._cond:
+            return {
+                'active': self._active,
+                'waiting': self._waiting,
+                'waiting_users': len(self._queues),
+                'avg_service_time': round(self._avg_service_time, 3),
+            }
+
+
+limiter = TokenBucketLimiter(BUCKET_CAPACITY, BUCKET_REFILL_PER_SECOND)
+scheduler = FairScheduler(UPSTREAM_CONCURRENCY, REPLY_DEADLINE_SECONDS)
+
+# 目前執行緒代表哪位用戶呼叫上游：(user_id, 是否扣除額度)
+_context = threading.local()
+
+
+@contextmanager
+def acting_as(user_id: str, charge: bool = True):
+    """在此區塊內呼叫上游時，以 user_id 的身分扣除額度並排隊"""
+    previous = getattr(_context, 'caller', None)
+    _context.caller = (user_id, charge)
+    try:
+        yield
+    finally:
+        _context.caller = previous
+
+
+def call_upstream(func: Callable[[], str]) -> str:
+    """
+    實際呼叫上游（OpenAI）前扣除 LLM 查詢額度並取得排程名額；
+    快取命中不會走到這裡，因此不扣額度也不影響平均服務時間。
+    額度不足拋出 RateLimited，排不到名額拋出 LoadShed
+    """
+    user_id, charge = getattr(_context, 'caller', None) or (BACKGROUND_USER_ID, False)
+    # 每則訊息已先扣過便宜指令的額度，這裡補扣差額
+    if charge and not limiter.try_consume(user_id, COST_EXPENSIVE - COST_CHEAP):
+        raise RateLimited(f"{user_id} 額度不足")
+    return scheduler.run(user_id, func)
+
+memory_budget.register_store('rate_limit', lambda: limiter._buckets, limiter.evict, 8)
@@ -0,0 +1,198 @@
+# render.py - 結構化回答（JSON）的欄位定義與本地文字範本
+#
+# ANSWER_MODE=structured 時，規格、價格與排行榜只向上游要求精簡 JSON，
+# 快取中依範本語言保存紀錄（欄位值使用該語言），回覆時再套用對應語言的範本
+import json
+import logging
+import re
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+STRUCTURED_INTENTS = ('spec', 'price', 'ranking')
+
+# 結構化紀錄在回答快取中使用的語言欄位值（繁中紀錄；其他範本語言加上後綴）
+RECORD_LANGUAGE = 'record'
+
+# 有範本的語言與要求上游填寫欄位值時使用的語言，其他語言使用繁中範本
+VALUE_LANGUAGES = {
+    'zh-tw': '繁體中文',
+    'en': '英文',
+}
+
+# 各意圖要求的 JSON 格式（以中文描述欄位內容，值的語言另由系統提示指定，不知道的欄位填 null）
+SCHEMAS = {
+    'spec': (
+        '{"name":"完整型號","brand":"品牌","release":"發表年月","cpu":"處理器","ram":"記憶體",'
+        '"storage":["容量"],"display":"螢幕","battery":"電池","camera":"相機","os":"作業系統",'
+        '"highlights":["特色，最多3項"],"pros":["優點，最多3項"],"cons":["缺點，最多3項"],'
+        '"suitable_for":"適用族群"}'
+    ),
+    'price': (
+        '{"name":"完整型號","new":[{"store":"通路","price":新台幣整數}],'
+        '"used":[{"condition":"成色","min":新台幣整數,"max":新台幣整數}],"note":"補充說明或null"}'
+    ),
+    'ranking': (
+        '{"category":"類別","items":[{"rank":名次,"name":"產品","price_range":"價格區間",'
+        '"highlight":"核心特色","suitable_for":"適用族群"}]}'
+    ),
+}
+
+# 結構化回答的輸出長度遠小於條列文字
+MAX_TOKENS = {
+    'spec': 500,
+    'price': 350,
+    'ranking': 700,
+}
+
+LABELS = {
+    'zh-tw': {
+        'brand': '品牌', 'release': '發表時間', 'cpu': '處理器', 'ram': '記憶體',
+        'storage': '儲存空間', 'display': '螢幕', 'battery': '電池', 'camera': '相機',
+        'os': '作業系統', 'highlights': '特色', 'pros': '優點', 'cons': '缺點',
+        'suitable_for': '適合族群', 'new': '新品價格', 'used': '二手行情',
+        'ranking': '熱門排行榜', 'no_data': '目前查無資料，請提供更具體的產品型號。',
+        'colon': '：',
+    },
+    'en': {
+        'brand': 'Brand', 'release': 'Released', 'cpu': 'Processor', 'ram': 'Memory',
+        'storage': 'Storage', 'display': 'Display', 'battery': 'Battery', 'camera': 'Camera',
+        'os': 'OS', 'highlights': 'Highlights', 'pros': 'Pros', 'cons': 'Cons',
+        'suitable_for': 'Best for', 'new': 'New', 'used': 'Used',
+        'ranking': 'Top picks', 'no_data': 'No data found. Please try a more specific model name.',
+        'colon': ': ',
+    },
+}
+
+SPEC_FIELDS = ['brand', 'release', 'cpu', 'ram', 'storage', 'display', 'battery', 'camera', 'os']
+SPEC_LIST_FIELDS = ['highlights', 'pros', 'cons']
+
+
+def template_language(language: str) -> str:
+    """用戶語言對應的範本語言（沒有範本的語言使用繁中）"""
+    return language if language in VALUE_LANGUAGES else 'zh-tw'
+
+
+def record_language(language: str) -> str:
+    """此範本語言的紀錄在回答快取中的語言欄位值"""
+    language = template_language(language)
+    return RECORD_LANGUAGE if language == 'zh-tw' else f'{RECORD_LANGUAGE}-{language}'
+
+
+def system_prompt(intent: str, language: str = 'zh-tw') -> str:
+    """要求上游只輸出指定格式 JSON 的系統提示"""
+    return (
+        "你是專業的3C產品資料助理，資料以台灣市場為準。"
+        "只輸出一個符合以下格式的 JSON 物件，不要加上說明文字、程式碼區塊或外部連結，"
+        f"文字欄位的值以{VALUE_LANGUAGES[template_language(language)]}填寫（型號與品牌維持原文），"
+        "每個值盡量簡短，不確定的欄位填 null：\n" + SCHEMAS[intent]
+    )
+
+
+def parse_record(raw: str) -> Dict:
+    """解析上游回傳的 JSON；不是 JSON 物件時（通常是被輸出上限截斷）拋出 ValueError"""
+    match = re.search(r'\{.*\}', raw or '', re.DOTALL)
+    if match:
+        try:
+            record = json.loads(match.group(0))
+        except ValueError:
+            record = None
+        if isinstance(record, dict):
+            return record
+    raise ValueError(f"結構化回答不是有效的 JSON（{len(raw or '')} 字元）")
+
+
+def dumps(record: Dict) -> str:
+    """以最精簡的格式序列化紀錄，供快取保存"""
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+
+
+def _join(value) -> str:
+    if isinstance(value, list):
+        return ' / '.join(str(item) for item in value if item)
+    return str(value) if value not in (None, '') else ''
+
+
+def _price(value) -> str:
+    return f"${value:,.0f}" if isinstance(value, (int, float)) else _join(value)
+
+
+def _render_spec(record: Dict, labels: Dict) -> List[str]:
+    lines = [f"📱 {record['name']}"] if record.get('name') else []
+    for field in SPEC_FIELDS:
+        value = _join(record.get(field))
+        if value:
+            lines.append(f"• {labels[field]}{labels['colon']}{value}")
+    for field in SPEC_LIST_FIELDS:
+        items = [item for item in record.get(field) or [] if item]
+        if items:
+            lines.append(f"\n{labels[field]}{labels['colon'].strip()}")
+            lines.extend(f"- {item}" for item in items)
+    suitable_for = _join(record.get('suitable_for'))
+    if suitable_for:
+        lines.append(f"\n{labels['suitable_for']}{labels['colon']}{suitable_for}")
+    return lines
+
+
+def _render_price(record: Dict, labels: Dict) -> List[str]:
+    lines = [f"💰 {record['name']}"] if record.get('name') else []
+    offers = [offer for offer in record.get('new') or [] if isinstance(offer, dict)]
+    if offers:
+        lines.append(f"\n{labels['new']}{labels['colon'].strip()}")
+        lines.extend(
+            f"- {offer.get('store', '')}{labels['colon']}{_price(offer.get('price'))}" for offer in offers
+        )
+    used = [offer for offer in record.get('used') or [] if isinstance(offer, dict)]
+    if used:
+        lines.append(f"\n{labels['used']}{labels['colon'].strip()}")
+        lines.extend(
+            f"- {offer.get('condition', '')}{labels['colon']}{_price(offer.get('min'))} ~ {_price(offer.get('max'))}"
+            for offer in used
+        )
+    if record.get('note'):
+        lines.append(f"\n{_join(record['note'])}")
+    return lines
+
+
+def _render_ranking(record: Dict, labels: Dict) -> List[str]:
+    items = [item for item in record.get('items') or [] if isinstance(item, dict)]
+    if not items:
+        return []
+    lines = [f"🏆 {_join(record.get('category'))} {labels['ranking']}"]
+    for position, item in enumerate(items, 1):
+        lines.append(f"\n{item.get('rank') or position}. {item.get('name', '')}")
+        for field in ('price_range', 'highlight', 'suitable_for'):
+            value = _join(item.get(field))
+            if value:
+                lines.append(f"   {value}")
+    return lines
+
+
+_RENDERERS = {
+    'spec': _render_spec,
+    'price': _render_price,
+    'ranking': _render_ranking,
+}
+
+
+def render(intent: str, stored: str, language: str = 'zh-tw') -> str:
+    """將快取的結構化紀錄套用範本轉成文字回覆"""
+    try:
+        record = json.loads(stored)
+    except ValueError:
+        # 切換模式前留下的文字回答
+        return stored
+    if not isinstance(record, dict):
+        return stored
+    if 'text' in record:
+        # 舊版本在 JSON 解析失敗時保存的原文
+        return record['text']
+
+    labels = LABELS[template_language(language)]
+    try:
+        lines = _RENDERERS[intent](record, labels)
+    except Exception as e:
+        logger.error(f"套用回答範本失敗 ({intent}): {e}")
+        lines = []
+    text = '\n'.join(lines).strip()
+    return text or labels['no_data']
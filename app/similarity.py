@@ -0,0 +1,192 @@
+# similarity.py - 近似查詢比對（字元 n-gram MinHash + LSH）
+#
+# 將「iPhone 15 售價」、「iphone15價格」對應到同一個已快取的回答；
+# 型號中的英數字必須完全相同，避免 iPhone 15 被對應到 iPhone 14
+import hashlib
+import itertools
+import logging
+import operator
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_THRESHOLD = float(os.getenv('SIMILAR_QUERY_THRESHOLD', '0.7'))
+# 每筆約 1.1 KB（簽章、索引鍵與 8 個 band），預設上限約 22 MB，在 32 MB 的記憶體預算內
+MAX_ENTRIES = int(os.getenv('SIMILAR_QUERY_MAX_ENTRIES', '20000'))
+
+# 32 個雜湊分成 8 個 band，每個 band 4 列；相似度約 0.6 以上的查詢大多會成為候選
+NUM_HASHES = 32
+BANDS = 8
+ROWS_PER_BAND = NUM_HASHES // BANDS
+SHINGLE_SIZE = 2
+
+# 查詢中不影響答案的詞，比對前移除（輸入需已經過 answer_cache.normalize_query）
+FILLER_WORDS = [
+    '多少錢', '價格', '售價', '報價', '價錢', '價位', '規格', '參數', '評價', '評測',
+    '心得', '推薦', '排行榜', '請問', '一下', '的'
+]
+_FILLER_PATTERN = re.compile('|'.join(re.escape(word) for word in FILLER_WORDS))
+_TOKEN_PATTERN = re.compile(r'[a-z]+|\d+')
+
+# 每個 shingle 以一次 SHAKE-128 產生 NUM_HASHES 個 32 位元雜湊值
+_HASH_FORMAT = struct.Struct(f'<{NUM_HASHES}I')
+
+
+def _shingles(text: str) -> set:
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def guard_tokens(text: str) -> frozenset:
+    """型號中的英文與數字片段，兩個查詢必須完全相同才視為同一產品"""
+    return frozenset(_TOKEN_PATTERN.findall(text))
+
+
+def signature(text: str) -> Tuple[Tuple[int, ...], str]:
+    """計算 MinHash 簽章與英數字保護條件（排序後以空白連接的字串，比 frozenset 省記憶體）"""
+    core = _FILLER_PATTERN.sub('', text) or text
+    hashes = [
+        _HASH_FORMAT.unpack(hashlib.shake_128(shingle.encode()).digest(_HASH_FORMAT.size))
+        for shingle in _shingles(core)
+    ]
+    minhash = tuple(map(min, zip(*hashes)))
+    return minhash, ' '.join(sorted(guard_tokens(core)))
+
+
+def _entry_key(intent: str, language: str, query_key: str) -> str:
+    return f'{intent}\x1f{language}\x1f{query_key}'
+
+
+class SimilarQueryIndex:
+    """
+    依 (intent, language) 分區的近似查詢索引
+    簽章存成 array('I')，band 以雜湊值為鍵，bucket 只有一筆時直接存索引鍵字串
+    （與 _entries 共用同一個物件），多筆時才用 tuple
+    """
+
+    def __init__(self, threshold: float = SIMILARITY_THRESHOLD, max_entries: int = MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # 'intent\x1flanguage\x1fquery_key' -> (MinHash 簽章, 英數字保護條件)
+        self._entries: 'OrderedDict[str, Tuple[array, str]]' = OrderedDict()
+        self._buckets: Dict[int, Union[str, Tuple[str, ...]]] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def _band_keys(self, intent: str, language: str, minhash) -> Iterable[int]:
+        # 雜湊碰撞只會多出候選，候選仍須通過相似度門檻
+        for band in range(BANDS):
+            start = band * ROWS_PER_BAND
+            yield hash((intent, language, band, *minhash[start:start + ROWS_PER_BAND]))
+
+    def add(self, intent: str, language: str, query_key: str):
+        """加入已有回答的查詢"""
+        entry_key = _entry_key(intent, language, query_key)
+        minhash, guard = signature(query_key)
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                return
+            self._entries[entry_key] = (array('I', minhash), guard)
+            for band_key in self._band_keys(intent, language, minhash):
+                bucket = self._buckets.get(band_key)
+                if bucket is None:
+                    self._buckets[band_key] = entry_key
+                elif isinstance(bucket, str):
+                    self._buckets[band_key] = (bucket, entry_key)
+                else:
+                    self._buckets[band_key] = bucket + (entry_key,)
+            while len(self._entries) > self.max_entries:
+                self._remove_oldest()
+
+    def _remove_oldest(self):
+        entry_key, (minhash, _) = self._entries.popitem(last=False)
+        intent, language, _ = entry_key.split('\x1f', 2)
+        for band_key in self._band_keys(intent, language, minhash):
+            bucket = self._buckets.get(band_key)
+            if bucket is None:
+                continue
+            if isinstance(bucket, str):
+                if bucket == entry_key:
+                    del self._buckets[band_key]
+                continue
+            remaining = tuple(key for key in bucket if key != entry_key)
+            self._buckets[band_key] = remaining[0] if len(remaining) == 1 else remaining
+
+    def find(self, intent: str, language: str, query_key: str) -> Optional[str]:
+        """找出相似度最高且超過門檻的已知查詢"""
+        minhash, guard = signature(query_key)
+        best_key, best_score = None, self.threshold
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band_key in self._band_keys(intent, language, minhash):
+                bucket = self._buckets.get(band_key)
+                if isinstance(bucket, str):
+                    candidates.add(bucket)
+                elif bucket:
+                    candidates.update(bucket)
+            for candidate in candidates:
+                candidate_minhash, candidate_guard = self._entries[candidate]
+                if candidate_guard != guard:
+                    continue
+                score = sum(map(operator.eq, minhash, candidate_minhash)) / NUM_HASHES
+                if score >= best_score:
+                    best_key, best_score = candidate, score
+            if best_key is not None:
+                self.hits += 1
+        return best_key.split('\x1f', 2)[2] if best_key is not None else None
+
+    def approximate_bytes(self, sample_items: int = 200) -> int:
+        """
+        估算索引佔用的位元組數（抽樣推估）
+        bucket 內的字串與 _entries 的鍵是同一個物件，只計一次；通用的 memory_budget.approximate_size
+        抽樣時無法得知這點，會把這些字串重複計入
+        """
+        with self._lock:
+            size = sys.getsizeof(self._entries) + sys.getsizeof(self._buckets)
+            for container, measure in ((self._entries, self._entry_bytes), (self._buckets, self._bucket_bytes)):
+                count = len(container)
+                if not count:
+                    continue
+                step = max(1, count // sample_items)
+                sample = [measure(*item) for item in itertools.islice(container.items(), 0, None, step)]
+                size += sum(sample) * count // len(sample)
+        return size
+
+    @staticmethod
+    def _entry_bytes(entry_key: str, entry: Tuple[array, str]) -> int:
+        return sum(map(sys.getsizeof, (entry_key, entry, entry[0], entry[1])))
+
+    @staticmethod
+    def _bucket_bytes(band_key: int, bucket: Union[str, Tuple[str, ...]]) -> int:
+        return sys.getsizeof(band_key) + (0 if isinstance(bucket, str) else sys.getsizeof(bucket))
+
+    def evict(self, fraction: float) -> int:
+        """記憶體超過預算時移除最舊的項目"""
+        with self._lock:
+            count = min(len(self._entries), int(len(self._entries) * fraction) + 1)
+            for _ in range(count):
+                self._remove_oldest()
+        return count
+
+    def stats(self) -> Dict:
+        """索引大小與命中率"""
+        return {
+            'entries': len(self._entries),
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
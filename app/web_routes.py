@@ -1,21 +1,62 @@
-from flask import jsonify, request
+from flask import Response, jsonify, request
+import hmac
 import logging
+import os
 
 # 避免循環導入
-from .app import app, add_to_cart, get_cart_items, remove_from_cart
+from .app import (
+    app, add_to_cart, remove_from_cart,
+    apply_cart_operations, get_cart_page, get_cart_version
+)
+from . import answer_cache, export, hot_queries, memory_budget, profiling
 
 logger = logging.getLogger(__name__)
 
+# 分頁與批次上限
+MAX_PAGE_SIZE = 100
+MAX_BATCH_OPERATIONS = 200
+
+def _is_admin_request() -> bool:
+    """檢查管理 API 的 X-Admin-Token（未設定 ADMIN_TOKEN 時一律拒絕）"""
+    admin_token = os.getenv('ADMIN_TOKEN')
+    provided = request.headers.get('X-Admin-Token', '')
+    return bool(admin_token) and hmac.compare_digest(provided, admin_token)
+
+def _worker_info() -> dict:
+    """管理 API 只作用在處理這個請求的 worker（每個 worker 各自保存狀態），回應中標示是哪一個"""
+    return {'worker_pid': os.getpid()}
+
+def _admin_forbidden():
+    return jsonify({
+        'success': False,
+        'error': '沒有權限'
+    }), 403
+
 @app.route('/cart/<user_id>', methods=['GET'])
 def get_cart(user_id):
-    """取得購物車 API"""
+    """取得購物車 API（支援 cursor / limit 分頁與 If-None-Match）"""
     try:
-        items = get_cart_items(user_id)
-        return jsonify({
+        after_id = request.args.get('cursor', 0, type=int)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), MAX_PAGE_SIZE)
+        
+        # 購物車未異動時直接回傳 304，不查詢商品
+        version = get_cart_version(user_id)
+        etag = f"{version}-{after_id}-{limit}"
+        if request.if_none_match.contains(etag):
+            response = app.make_response(('', 304))
+            response.set_etag(etag)
+            return response
+        
+        items, next_cursor = get_cart_page(user_id, after_id, limit)
+        response = jsonify({
             'success': True,
             'items': items,
-            'count': len(items)
+            'count': len(items),
+            'next_cursor': next_cursor,
+            'version': version
         })
+        response.set_etag(etag)
+        return response
     except Exception as e:
         logger.error(f"取得購物車失敗: {e}")
         return jsonify({
@@ -72,12 +113,13 @@ def remove_from_cart_api():
                 'error': '缺少必要參數'
             }), 400
         
-        success = remove_from_cart(user_id, product_name)
+        removed = remove_from_cart(user_id, product_name)
         
-        if success:
+        if removed:
             return jsonify({
                 'success': True,
-                'message': f'已從購物車移除 {product_name}'
+                'message': f'已從購物車移除 {removed}',
+                'product_name': removed
             })
         else:
             return jsonify({
@@ -90,4 +132,207 @@ def remove_from_cart_api():
         return jsonify({
             'success': False,
             'error': '伺服器錯誤'
-        }), 500
\ No newline at end of file
+        }), 500
+
+@app.route('/cart/batch', methods=['POST'])
+def cart_batch_api():
+    """批次異動購物車 API（同一個交易，全部成功或全部不寫入）"""
+    try:
+        data = request.get_json()
+        user_id = data.get('user_id')
+        operations = data.get('operations')
+        
+        if not user_id or not isinstance(operations, list) or not operations:
+            return jsonify({
+                'success': False,
+                'error': '缺少必要參數'
+            }), 400
+        
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            return jsonify({
+                'success': False,
+                'error': f'單次最多 {MAX_BATCH_OPERATIONS} 筆操作'
+            }), 400
+        
+        try:
+            version = apply_cart_operations(user_id, operations)
+        except (ValueError, TypeError, AttributeError) as e:
+            return jsonify({
+                'success': False,
+                'error': f'操作內容不正確: {e}'
+            }), 400
+        
+        return jsonify({
+            'success': True,
+            'applied': len(operations),
+            'version': version
+        })
+            
+    except Exception as e:
+        logger.error(f"批次異動購物車 API 失敗: {e}")
+        return jsonify({
+            'success': False,
+            'error': '伺服器錯誤'
+        }), 500
+
+@app.route('/admin/profiling', methods=['GET', 'POST', 'DELETE'])
+def profiling_api():
+    """效能分析管理 API：GET 查詢狀態、POST 啟用抽樣、DELETE 停用並寫出結果"""
+    if not _is_admin_request():
+        return _admin_forbidden()
+    
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            sample_rate = float(data.get('sample_rate', 0.1))
+            max_samples = int(data.get('max_samples', 100))
+            if sample_rate <= 0 or max_samples <= 0:
+                return jsonify({
+                    'success': False,
+                    'error': 'sample_rate 與 max_samples 必須大於 0'
+                }), 400
+            profiling.start(sample_rate, max_samples)
+        elif request.method == 'DELETE':
+            profiling.stop()
+        
+        return jsonify({
+            'success': True,
+            'profiling': profiling.status(),
+            **_worker_info()
+        })
+            
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'error': '參數格式不正確'
+        }), 400
+    except Exception as e:
+        logger.error(f"效能分析 API 失敗: {e}")
+        return jsonify({
+            'success': False,
+            'error': '伺服器錯誤'
+        }), 500
+
+@app.route('/admin/memory', methods=['GET'])
+def memory_api():
+    """記憶體診斷 API：各儲存區用量與預算（只量測，不淘汰）"""
+    if not _is_admin_request():
+        return _admin_forbidden()
+    
+    try:
+        return jsonify({
+            'success': True,
+            'memory': memory_budget.diagnostics(),
+            **_worker_info()
+        })
+    except Exception as e:
+        logger.error(f"記憶體診斷 API 失敗: {e}")
+        return jsonify({
+            'success': False,
+            'error': '伺服器錯誤'
+        }), 500
+
+@app.route('/admin/memory/tracemalloc', methods=['POST'])
+def tracemalloc_api():
+    """tracemalloc API：action 為 start / snapshot / stop，snapshot 回傳與上次快照的差異"""
+    if not _is_admin_request():
+        return _admin_forbidden()
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        action = data.get('action', 'snapshot')
+        
+        diff = []
+        if action == 'start':
+            memory_budget.start_tracing(int(data.get('frames', 10)))
+        elif action == 'snapshot':
+            diff = memory_budget.snapshot_diff(int(data.get('limit', 20)))
+        elif action == 'stop':
+            memory_budget.stop_tracing()
+        else:
+            return jsonify({
+                'success': False,
+                'error': f'不支援的操作: {action}'
+            }), 400
+        
+        return jsonify({
+            'success': True,
+            'action': action,
+            'diff': diff,
+            **_worker_info()
+        })
+            
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'error': '參數格式不正確'
+        }), 400
+    except Exception as e:
+        logger.error(f"tracemalloc API 失敗: {e}")
+        return jsonify({
+            'success': False,
+            'error': '伺服器錯誤'
+        }), 500
+
+@app.route('/admin/answer-cache', methods=['GET'])
+def answer_cache_api():
+    """回答快取統計 API：新鮮 / 過期 / 近似查詢命中與未命中次數"""
+    if not _is_admin_request():
+        return _admin_forbidden()
+    
+    return jsonify({
+        'success': True,
+        'answer_cache': answer_cache.stats(),
+        **_worker_info()
+    })
+
+@app.route('/admin/hot-queries', methods=['GET'])
+def hot_queries_api():
+    """熱門查詢 API：目前與上一個時間窗的前幾名（次數含 Space-Saving 誤差上限）"""
+    if not _is_admin_request():
+        return _admin_forbidden()
+    
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    return jsonify({
+        'success': True,
+        'hot_queries': hot_queries.tracker.top(limit),
+        **_worker_info()
+    })
+
+@app.route('/admin/export/<name>', methods=['GET'])
+def export_api(name):
+    """
+    串流匯出 API：format=ndjson|csv，since 為上次的水位（UTC）
+    回應標頭 X-Export-Watermark 為下一次增量匯出要帶的 since
+    """
+    if not _is_admin_request():
+        return _admin_forbidden()
+    
+    if name not in export.EXPORTS:
+        return jsonify({
+            'success': False,
+            'error': f"可匯出項目：{', '.join(sorted(export.EXPORTS))}"
+        }), 404
+    
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        return jsonify({
+            'success': False,
+            'error': 'format 必須是 ndjson 或 csv'
+        }), 400
+    
+    try:
+        since, until = export.export_window(export.parse_watermark(request.args.get('since')))
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': 'since 格式應為 YYYY-MM-DD HH:MM:SS'
+        }), 400
+    
+    response = Response(
+        export.stream_export(name, fmt, since, until, export.DB_PATH),
+        mimetype=export.FORMATS[fmt]
+    )
+    response.headers['X-Export-Watermark'] = export.format_watermark(until)
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+    return response
\ No newline at end of file
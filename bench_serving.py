@@ -0,0 +1,120 @@
+# bench_serving.py - 比較預設 gunicorn 與預先載入設定的每個 worker 記憶體與吞吐量（僅 Linux）
+#
+# 用法：python bench_serving.py [--workers 2] [--requests 2000] [--clients 16]
+# 只打本地路由（健康檢查與購物車查詢），不會呼叫 LINE 或 OpenAI
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+# gunicorn 會自動載入工作目錄下的 gunicorn.conf.py，基準組需明確指定空設定才是真正的預設值
+CONFIGS = {
+    'default': ['gunicorn', '-c', os.devnull, 'wsgi:application'],
+    'preloaded': ['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application'],
+}
+
+PATHS = ['/', '/cart/bench-user']
+
+
+def _child_pids(pid: int) -> List[int]:
+    children = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return children
+
+
+def _memory_kb(pid: int) -> Dict[str, Optional[int]]:
+    """RSS 與 PSS（共用頁面依行程數平均分攤）"""
+    usage = {'rss_kb': None, 'pss_kb': None}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    usage['rss_kb'] = int(line.split()[1])
+                elif line.startswith('Pss:'):
+                    usage['pss_kb'] = int(line.split()[1])
+    except OSError:
+        pass
+    return usage
+
+
+def _wait_until_ready(base_url: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn 未在時間內啟動')
+
+
+def _load_test(base_url: str, total: int, clients: int) -> Dict:
+    def fetch(i: int) -> float:
+        started = time.perf_counter()
+        urllib.request.urlopen(base_url + PATHS[i % len(PATHS)], timeout=10).read()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = sorted(executor.map(fetch, range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests_per_second': round(total / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+    }
+
+
+def run_config(name: str, workers: int, port: int, total: int, clients: int) -> Dict:
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers))
+    command = CONFIGS[name] + ['--workers', str(workers), '--bind', f'127.0.0.1:{port}']
+    master = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        _wait_until_ready(base_url)
+        _load_test(base_url, min(total, 200), clients)  # 暖機
+        throughput = _load_test(base_url, total, clients)
+        worker_memory = [_memory_kb(pid) for pid in _child_pids(master.pid)]
+        return {
+            'workers': len(worker_memory),
+            'master': _memory_kb(master.pid),
+            'worker_rss_kb_avg': sum(m['rss_kb'] or 0 for m in worker_memory) // max(len(worker_memory), 1),
+            'worker_pss_kb_avg': sum(m['pss_kb'] or 0 for m in worker_memory) // max(len(worker_memory), 1),
+            **throughput,
+        }
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait(timeout=30)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='比較 gunicorn 預設與預先載入設定')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    if not sys.platform.startswith('linux'):
+        parser.error('需要 /proc 才能量測記憶體，僅支援 Linux')
+
+    results = {
+        name: run_config(name, args.workers, args.port, args.requests, args.clients)
+        for name in CONFIGS
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# gunicorn.conf.py - 正式環境設定：master 預先載入應用，worker 以執行緒處理 I/O 等待
+#
+# 用法：gunicorn -c gunicorn.conf.py wsgi:application
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# 在 master 匯入 SDK、建立路由與初始化資料庫一次，worker fork 後以 copy-on-write 共用
+preload_app = True
+os.environ['APP_PRELOADED'] = '1'
+
+# 回覆大多在等待 OpenAI，使用執行緒 worker；
+# 每個 worker 同時呼叫上游的數量另由 UPSTREAM_CONCURRENCY 限制。
+# 流量限制、快取與管理 API 的狀態都是每個 worker 各自一份（見 README）
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+# 搜尋模型回應可能超過 30 秒
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '90'))
+graceful_timeout = 30
+keepalive = 5
+
+
+def when_ready(server):
+    # 預先載入的物件移出 GC 追蹤，避免 worker 的垃圾回收觸碰共用頁面而複製
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # HTTP 連線池與背景執行緒不能跨 fork 共用，在每個 worker 中重新建立；
+    # SQLite 連線本來就是每次操作時才開啟，不需處理
+    from app.app import init_clients, start_background_tasks
+    init_clients()
+    start_background_tasks()
@@ -0,0 +1,90 @@
+import sqlite3
+
+import pytest
+
+from app import maintenance
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''
+        CREATE TABLE cart (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            product TEXT NOT NULL,
+            quantity INTEGER DEFAULT 1,
+            price REAL,
+            added_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            product_key TEXT
+        )
+    ''')
+    conn.execute('CREATE TABLE cart_versions (user_id TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)')
+    yield conn
+    conn.close()
+
+
+def _add(conn, user_id, product, quantity=1, added_time='2024-01-01 00:00:00', product_key=None):
+    conn.execute(
+        'INSERT INTO cart (user_id, product, quantity, added_time, updated_at, product_key) VALUES (?, ?, ?, ?, ?, ?)',
+        (user_id, product, quantity, added_time, added_time, product_key)
+    )
+
+
+def _cart(conn, user_id):
+    return conn.execute(
+        'SELECT product, product_key, quantity, updated_at FROM cart WHERE user_id = ? ORDER BY id', (user_id,)
+    ).fetchall()
+
+
+def test_merges_rows_that_normalize_to_the_same_product(conn):
+    _add(conn, 'u1', 'iPhone 15', 1, '2024-01-01 00:00:00')
+    _add(conn, 'u1', 'iphone15', 2, '2024-03-01 00:00:00')
+    _add(conn, 'u2', 'iPhone 15', 1)
+    conn.execute("INSERT INTO cart_versions VALUES ('u1', 3), ('u2', 5)")
+
+    assert maintenance.migrate_cart_product_keys(conn) == 1
+
+    assert _cart(conn, 'u1') == [('iPhone 15', 'iphone15', 3, '2024-03-01 00:00:00')]
+    assert _cart(conn, 'u2') == [('iPhone 15', 'iphone15', 1, '2024-01-01 00:00:00')]
+    versions = dict(conn.execute('SELECT user_id, version FROM cart_versions'))
+    assert versions == {'u1': 4, 'u2': 5}
+
+
+def test_plus_models_stay_separate(conn):
+    _add(conn, 'u1', 'Galaxy S24')
+    _add(conn, 'u1', 'Galaxy S24+', 2)
+    _add(conn, 'u1', 'Note 10+')
+    _add(conn, 'u1', 'Note 10')
+
+    assert maintenance.migrate_cart_product_keys(conn) == 0
+
+    assert [row[:3] for row in _cart(conn, 'u1')] == [
+        ('Galaxy S24', 'galaxys24', 1),
+        ('Galaxy S24+', 'galaxys24plus', 2),
+        ('Note 10+', 'note10plus', 1),
+        ('Note 10', 'note10', 1),
+    ]
+
+
+def test_recomputes_keys_written_by_an_older_normalizer(conn):
+    # 舊規則會移除 +，Galaxy S24+ 被存成 galaxys24
+    _add(conn, 'u1', 'Galaxy S24+', 1, product_key='galaxys24')
+    _add(conn, 'u1', 'Galaxy S24+', 2, '2024-02-01 00:00:00', product_key='galaxys24plus')
+    conn.execute('CREATE UNIQUE INDEX idx_cart_user_product_key ON cart (user_id, product_key)')
+
+    assert maintenance.migrate_cart_product_keys(conn) == 1
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_user_product_key ON cart (user_id, product_key)')
+
+    assert _cart(conn, 'u1') == [('Galaxy S24+', 'galaxys24plus', 3, '2024-02-01 00:00:00')]
+
+
+def test_noop_when_keys_are_current(conn):
+    _add(conn, 'u1', 'Pixel 8', product_key='pixel8')
+    conn.execute('CREATE UNIQUE INDEX idx_cart_user_product_key ON cart (user_id, product_key)')
+
+    assert maintenance.migrate_cart_product_keys(conn) == 0
+
+    indexes = [row[1] for row in conn.execute('PRAGMA index_list(cart)')]
+    assert 'idx_cart_user_product_key' in indexes
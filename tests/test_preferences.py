@@ -0,0 +1,51 @@
+import pytest
+
+from app import preferences
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(preferences, '_cache', {})
+    monkeypatch.setattr(preferences, '_dirty', set())
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('iPhone 15 價格', 'zh-tw'),
+    ('MacBook Air M3 評價', 'zh-tw'),
+    ('iPhone 15 の価格', 'ja'),
+    ('갤럭시 S24 가격', 'ko'),
+    ('iPhone 15 price', None),
+])
+def test_script_language(text, expected):
+    assert preferences.script_language(text) == expected
+
+
+def test_mixed_script_is_not_learned_as_english():
+    # langdetect 會把夾帶英文型號的中文問題判成英文
+    preferences.learn('u1', 'iPhone 15 價格', 'en')
+    preferences.learn('u1', 'MacBook Air M3 評價', 'en')
+
+    assert preferences.get_language('u1') == 'zh-tw'
+
+
+def test_wrong_language_is_corrected_when_script_differs():
+    preferences.learn('u1', 'what is the price', 'en')
+    preferences.learn('u1', 'battery life review', 'en')
+    assert preferences.get_language('u1') == 'en'
+
+    assert preferences.language_check_due('u1', 'iPhone 15 多少錢')
+    preferences.learn('u1', 'iPhone 15 多少錢', 'en')
+    assert preferences.language_check_due('u1', 'Pixel 8 評價如何')
+    preferences.learn('u1', 'Pixel 8 評價如何', 'en')
+
+    assert preferences.get_language('u1') == 'zh-tw'
+
+
+def test_known_language_is_rechecked_periodically(monkeypatch):
+    monkeypatch.setattr(preferences, 'LANGUAGE_RECHECK_MESSAGES', 3)
+    preferences.learn('u1', 'iPhone 15 價格', 'zh-tw')
+    preferences.learn('u1', 'iPhone 15 價格', 'zh-tw')
+
+    due = [preferences.language_check_due('u1', 'iphone 15 pro max') for _ in range(6)]
+
+    assert due == [False, False, True, False, False, True]
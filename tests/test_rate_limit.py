@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from app import rate_limit
+
+
+def _run_concurrently(scheduler, jobs, user_ids, work_seconds):
+    active = []
+    peak = []
+    starts = []
+    ends = []
+    lock = threading.Lock()
+    errors = []
+
+    def work():
+        with lock:
+            starts.append(time.monotonic())
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(work_seconds)
+        with lock:
+            active.pop()
+            ends.append(time.monotonic())
+        return 'ok'
+
+    def client(i):
+        try:
+            scheduler.run(user_ids[i % len(user_ids)], work)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(starts), sorted(ends), max(peak), errors
+
+
+@pytest.mark.parametrize('user_ids', [['u1'], ['u1', 'u2', 'u3', 'u4', 'u5']])
+def test_fair_scheduler_keeps_all_slots_busy(user_ids):
+    scheduler = rate_limit.FairScheduler(max_concurrent=4, deadline=30)
+    scheduler._avg_service_time = 0.1
+    work_seconds = 0.1
+
+    starts, ends, peak, errors = _run_concurrently(scheduler, 40, user_ids, work_seconds)
+
+    assert errors == []
+    assert len(starts) == 40
+    assert peak == 4
+    # 第 i 個工作（i >= 4）要等第 i-4 個工作結束空出名額；
+    # 名額空出後若沒有立刻放行排隊中的工作，間隔會接近一個工作的時間
+    gaps = [start - end for start, end in zip(starts[4:], ends)]
+    assert max(gaps) < work_seconds / 2
+    assert scheduler.stats()['waiting'] == 0
+
+
+def test_fair_scheduler_sheds_when_queue_exceeds_deadline():
+    scheduler = rate_limit.FairScheduler(max_concurrent=1, deadline=0.5)
+    scheduler._avg_service_time = 1.0
+    release = threading.Event()
+    holder = threading.Thread(target=scheduler.run, args=('u1', release.wait))
+    holder.start()
+    while scheduler.stats()['active'] == 0:
+        time.sleep(0.01)
+
+    with pytest.raises(rate_limit.LoadShed):
+        scheduler.run('u2', lambda: 'ok')
+
+    release.set()
+    holder.join()
@@ -1,16 +1,21 @@
 # wsgi.py - 應用程序入口點
+import os
 
 # 初始化資料庫
-from app.app import app as application, init_database
+from app.app import app as application, init_database, start_background_tasks
 
 # 確保資料庫已初始化
 init_database()
 
+# 定期清理過期資料與壓縮資料庫、檢查記憶體預算、批次寫回用戶偏好、預熱熱門查詢；
+# 以 gunicorn.conf.py 預先載入時，背景執行緒改由 post_fork 在各 worker 中啟動
+if not os.environ.get('APP_PRELOADED'):
+    start_background_tasks()
+
 # 導入路由
 import app.web_routes
 
 if __name__ == "__main__":
     # 本地運行
-    import os
     port = int(os.environ.get("PORT", 5000))
     application.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file